@@ -1,4 +1,4 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, Chat
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 import subprocess
 import os
@@ -8,6 +8,16 @@ import tempfile
 import logging
 import time
 import asyncio
+import shutil
+import urllib.parse
+import urllib.request
+import signal
+import threading
+import json
+import uuid
+import struct
+import httpx
+from collections import deque
 from datetime import datetime
 
 # Configurar logging
@@ -17,6 +27,58 @@ logger = logging.getLogger(__name__)
 TOKEN = os.environ.get('TOKEN')
 DOWNLOAD_DIR = "descargas"
 
+# Almacenamiento temporal de trabajos (staging)
+STAGING_DIR = os.environ.get('STAGING_DIR', os.path.join(tempfile.gettempdir(), 'musicbot_staging'))
+STAGING_PRESUPUESTO_MB = int(os.environ.get('STAGING_PRESUPUESTO_MB', '4096'))
+STAGING_MARGEN_LIBRE_MB = int(os.environ.get('STAGING_MARGEN_LIBRE_MB', '512'))
+STAGING_ESPERA_MAX = int(os.environ.get('STAGING_ESPERA_MAX', '120'))
+STAGING_DESCONOCIDO_MB = int(os.environ.get('STAGING_DESCONOCIDO_MB', '256'))
+TMPFS_DIR = os.environ.get('TMPFS_DIR', '/dev/shm')
+TMPFS_PRESUPUESTO_MB = int(os.environ.get('TMPFS_PRESUPUESTO_MB', '256'))
+TMPFS_MAX_TRABAJO_MB = int(os.environ.get('TMPFS_MAX_TRABAJO_MB', '64'))
+TMPFS_MARGEN_LIBRE_MB = int(os.environ.get('TMPFS_MARGEN_LIBRE_MB', '8'))
+
+# Límite de tamaño de archivo de la Bot API de Telegram
+LIMITE_ENVIO_MB = 50
+
+# Streaming de audio sin disco (yt-dlp | ffmpeg | subida)
+STREAMING_HABILITADO = os.environ.get('STREAMING_HABILITADO', '0') == '1'
+STREAMING_CHUNK_KB = int(os.environ.get('STREAMING_CHUNK_KB', '64'))
+STREAMING_BUFFER_CHUNKS = int(os.environ.get('STREAMING_BUFFER_CHUNKS', '32'))
+
+# Descargas multi-conexión y presupuesto global de red (0 = sin límite de ancho de banda)
+DESCARGA_CONEXIONES_TRABAJO = int(os.environ.get('DESCARGA_CONEXIONES_TRABAJO', '4'))
+DESCARGA_CONEXIONES_GLOBAL = int(os.environ.get('DESCARGA_CONEXIONES_GLOBAL', '16'))
+DESCARGA_ANCHO_BANDA_KBPS = int(os.environ.get('DESCARGA_ANCHO_BANDA_KBPS', '0'))
+DESCARGA_ARIA2C = os.environ.get('DESCARGA_ARIA2C', '1') == '1'
+
+# Prefetch especulativo de la fuente mientras el usuario elige formato
+PREFETCH_HABILITADO = os.environ.get('PREFETCH_HABILITADO', '0') == '1'
+PREFETCH_MAX_MB_USUARIO = int(os.environ.get('PREFETCH_MAX_MB_USUARIO', '100'))
+PREFETCH_MAX_MB_GLOBAL = int(os.environ.get('PREFETCH_MAX_MB_GLOBAL', '400'))
+PREFETCH_MAX_GLOBAL = int(os.environ.get('PREFETCH_MAX_GLOBAL', '4'))
+PREFETCH_TTL = int(os.environ.get('PREFETCH_TTL', '300'))
+# Parte del ancho de banda de un prefetch respecto a la de un trabajo real
+PREFETCH_PESO_ANCHO_BANDA = float(os.environ.get('PREFETCH_PESO_ANCHO_BANDA', '0.25'))
+
+# Plazos por etapa (segundos); al vencer, el trabajo se cancela y libera sus recursos
+PLAZO_ANALISIS = int(os.environ.get('PLAZO_ANALISIS', '60'))
+PLAZO_DESCARGA = int(os.environ.get('PLAZO_DESCARGA', '1800'))
+PLAZO_ENVIO = int(os.environ.get('PLAZO_ENVIO', '900'))
+# Tiempo máximo que un trabajo cancelado espera a que su hilo de yt-dlp se detenga
+ESPERA_HILO_CANCELADO = int(os.environ.get('ESPERA_HILO_CANCELADO', '60'))
+
+# Circuit breakers por plataforma y motor de descarga
+CIRCUITO_VENTANA = int(os.environ.get('CIRCUITO_VENTANA', '300'))
+CIRCUITO_MIN_LLAMADAS = int(os.environ.get('CIRCUITO_MIN_LLAMADAS', '5'))
+CIRCUITO_UMBRAL_ERROR = float(os.environ.get('CIRCUITO_UMBRAL_ERROR', '0.5'))
+CIRCUITO_APERTURA = int(os.environ.get('CIRCUITO_APERTURA', '120'))
+
+# Journal de trabajos para reanudar descargas tras un reinicio
+JOURNAL_PATH = os.environ.get('JOURNAL_PATH', os.path.join(DOWNLOAD_DIR, 'trabajos.json'))
+REANUDAR_MAX_INTENTOS = int(os.environ.get('REANUDAR_MAX_INTENTOS', '3'))
+REANUDAR_MAX_HORAS = int(os.environ.get('REANUDAR_MAX_HORAS', '24'))
+
 # ==================== CLASE PARA TRACKING DE PROGRESO ====================
 
 class ProgressTracker:
@@ -27,6 +89,8 @@ class ProgressTracker:
         self.current_task = ""
         self.task_times = {}
         self.task_start = None
+        # Teclado que se mantiene en cada edición (botón de cancelar)
+        self.reply_markup = None
 
     async def start_task(self, task_name):
         """Inicia una nueva tarea y registra el tiempo"""
@@ -72,6 +136,7 @@ class ProgressTracker:
         total_time = time.time() - self.start_time
 
         status = "✅ PROCESO COMPLETADO" if success else "❌ PROCESO FALLIDO"
+        self.reply_markup = None
 
         mensaje = f"{status}\n"
         mensaje += f"🕐 Tiempo total: {total_time:.1f}s\n\n"
@@ -86,11 +151,562 @@ class ProgressTracker:
     async def update_message(self, text):
         """Actualiza el mensaje de Telegram"""
         try:
-            await self.message.edit_text(text)
+            await self.message.edit_text(text, reply_markup=self.reply_markup)
         except Exception as e:
             # Si falla la edición, enviar nuevo mensaje
             logger.error(f"Error editando mensaje: {e}")
 
+# ==================== ALMACENAMIENTO TEMPORAL (STAGING) ====================
+
+MB = 1024 * 1024
+
+# Bitrates aproximados (kbps) para predecir el tamaño de cada formato
+BITRATE_FUENTE_AUDIO_KBPS = 160
+BITRATE_FUENTE_VIDEO_KBPS = 2500
+BITRATES_SALIDA_KBPS = {
+    'mp3': 192,
+    'flac': 900,
+    'wav': 1536,
+}
+
+class EspacioInsuficienteError(Exception):
+    """No hay espacio de staging disponible para el trabajo"""
+
+def estimar_tamano_trabajo(info, formato):
+    """Predice los bytes de staging de un trabajo (fuente + salida) a partir de su info"""
+    duracion = 0
+    if info:
+        duracion = info.get('duracion_total') or info.get('duracion') or 0
+
+    if not duracion:
+        return STAGING_DESCONOCIDO_MB * MB
+
+    if formato == "mp4":
+        # El video se descarga ya en su contenedor final
+        tamaño = info.get('tamaño_aprox') or duracion * BITRATE_FUENTE_VIDEO_KBPS * 1000 / 8
+    else:
+        fuente = duracion * BITRATE_FUENTE_AUDIO_KBPS * 1000 / 8
+        salida = duracion * BITRATES_SALIDA_KBPS.get(formato, BITRATE_FUENTE_AUDIO_KBPS) * 1000 / 8
+        tamaño = fuente + salida
+
+    # Margen del 20% para metadatos, portadas y errores de estimación
+    return int(tamaño * 1.2)
+
+class VolumenStaging:
+    """Directorio raíz de staging con su propio presupuesto de espacio"""
+    def __init__(self, nombre, raiz, presupuesto, margen_libre):
+        self.nombre = nombre
+        self.raiz = raiz
+        self.presupuesto = presupuesto
+        # Espacio que siempre se deja libre en el sistema de archivos
+        self.margen_libre = margen_libre
+        self.reservado = 0
+
+    def espacio_libre(self):
+        """Bytes libres reales en el sistema de archivos del volumen"""
+        try:
+            os.makedirs(self.raiz, exist_ok=True)
+            return shutil.disk_usage(self.raiz).free
+        except OSError as e:
+            logger.error(f"Error consultando espacio de {self.raiz}: {e}")
+            return 0
+
+    def admite(self, bytes_estimados):
+        """Indica si la reserva cabe en el presupuesto y en el disco real"""
+        if self.reservado + bytes_estimados > self.presupuesto:
+            return False
+        return bytes_estimados <= self.espacio_libre() - self.margen_libre
+
+class ReservaStaging:
+    """Directorio de trabajo con espacio reservado; se libera al salir del contexto"""
+    def __init__(self, gestor, volumen, ruta, bytes_reservados):
+        self.gestor = gestor
+        self.volumen = volumen
+        self.ruta = ruta
+        self.bytes_reservados = bytes_reservados
+        self.liberada = False
+        # Si es persistente, un apagado (CancelledError) conserva los archivos para reanudar
+        self.persistente = False
+
+    async def liberar(self):
+        """Borra el directorio y devuelve el espacio al presupuesto"""
+        if self.liberada:
+            return
+        self.liberada = True
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, shutil.rmtree, self.ruta, True)
+        await self.gestor._devolver(self)
+
+    async def __aenter__(self):
+        return self.ruta
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.persistente and exc_type is asyncio.CancelledError:
+            self.liberada = True
+            await self.gestor._devolver(self)
+            return
+        await self.liberar()
+
+class GestorStaging:
+    """Reparte el espacio temporal entre trabajos según su tamaño previsto"""
+    PREFIJO = "trabajo_"
+
+    def __init__(self):
+        self.disco = VolumenStaging(
+            "disco", STAGING_DIR, STAGING_PRESUPUESTO_MB * MB, STAGING_MARGEN_LIBRE_MB * MB
+        )
+        self.tmpfs = None
+        if TMPFS_PRESUPUESTO_MB > 0 and os.path.isdir(TMPFS_DIR):
+            self.tmpfs = VolumenStaging(
+                "tmpfs", os.path.join(TMPFS_DIR, "musicbot_staging"),
+                TMPFS_PRESUPUESTO_MB * MB, TMPFS_MARGEN_LIBRE_MB * MB
+            )
+        self._condicion = asyncio.Condition()
+
+    def volumenes(self):
+        return [v for v in (self.tmpfs, self.disco) if v]
+
+    def _elegir_volumen(self, bytes_estimados, permitir_tmpfs):
+        """Elige tmpfs para trabajos pequeños de audio y disco para el resto"""
+        if (permitir_tmpfs and self.tmpfs and bytes_estimados <= TMPFS_MAX_TRABAJO_MB * MB
+                and self.tmpfs.admite(bytes_estimados)):
+            return self.tmpfs
+        if self.disco.admite(bytes_estimados):
+            return self.disco
+        return None
+
+    async def reservar(self, bytes_estimados, permitir_tmpfs=False, al_esperar=None, timeout=STAGING_ESPERA_MAX):
+        """Reserva espacio para un trabajo, esperando hasta `timeout` si el presupuesto está agotado"""
+        if bytes_estimados > self.disco.presupuesto:
+            raise EspacioInsuficienteError(
+                f"el trabajo necesita ~{bytes_estimados / MB:.0f}MB y el límite es "
+                f"{self.disco.presupuesto / MB:.0f}MB"
+            )
+
+        limite = time.monotonic() + timeout
+        avisado = False
+
+        while True:
+            async with self._condicion:
+                volumen = self._elegir_volumen(bytes_estimados, permitir_tmpfs)
+                if volumen:
+                    volumen.reservado += bytes_estimados
+                    break
+
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    raise EspacioInsuficienteError(
+                        f"sin espacio temporal para ~{bytes_estimados / MB:.0f}MB"
+                    )
+
+                if avisado or not al_esperar:
+                    # Revisar periódicamente: el espacio libre real cambia sin notificación
+                    try:
+                        await asyncio.wait_for(self._condicion.wait(), timeout=min(restante, 5))
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+            # Avisar fuera del lock para no bloquear las liberaciones
+            avisado = True
+            await al_esperar()
+
+        try:
+            os.makedirs(volumen.raiz, exist_ok=True)
+            ruta = tempfile.mkdtemp(prefix=self.PREFIJO, dir=volumen.raiz)
+        except OSError:
+            async with self._condicion:
+                volumen.reservado -= bytes_estimados
+                self._condicion.notify_all()
+            raise
+
+        logger.info(
+            f"Staging reservado en {volumen.nombre}: {bytes_estimados / MB:.1f}MB "
+            f"({volumen.reservado / MB:.0f}/{volumen.presupuesto / MB:.0f}MB)"
+        )
+        return ReservaStaging(self, volumen, ruta, bytes_estimados)
+
+    async def readoptar(self, ruta, bytes_reservados):
+        """Vuelve a contabilizar el staging de un trabajo reanudado; sus datos ya ocupan disco"""
+        volumen = next(
+            (v for v in self.volumenes() if os.path.dirname(os.path.abspath(ruta)) == os.path.abspath(v.raiz)),
+            self.disco
+        )
+        async with self._condicion:
+            volumen.reservado += bytes_reservados
+        return ReservaStaging(self, volumen, ruta, bytes_reservados)
+
+    async def ajustar(self, reserva, bytes_reservados):
+        """Cambia el tamaño contabilizado de una reserva ya en uso (p. ej. un prefetch adoptado)"""
+        async with self._condicion:
+            reserva.volumen.reservado += bytes_reservados - reserva.bytes_reservados
+            reserva.bytes_reservados = bytes_reservados
+            self._condicion.notify_all()
+
+    async def _devolver(self, reserva):
+        async with self._condicion:
+            reserva.volumen.reservado -= reserva.bytes_reservados
+            self._condicion.notify_all()
+
+    def limpiar_huerfanos(self, conservar=()):
+        """Elimina directorios de trabajos anteriores que no figuran en `conservar`"""
+        eliminados = 0
+        liberados = 0
+        for volumen in self.volumenes():
+            if not os.path.isdir(volumen.raiz):
+                continue
+            for nombre in os.listdir(volumen.raiz):
+                ruta = os.path.join(volumen.raiz, nombre)
+                if not nombre.startswith(self.PREFIJO) or not os.path.isdir(ruta):
+                    continue
+                if ruta in conservar:
+                    continue
+                for raiz, _, archivos in os.walk(ruta):
+                    for archivo in archivos:
+                        try:
+                            liberados += os.path.getsize(os.path.join(raiz, archivo))
+                        except OSError:
+                            pass
+                shutil.rmtree(ruta, ignore_errors=True)
+                eliminados += 1
+        return eliminados, liberados
+
+gestor_staging = GestorStaging()
+
+# ==================== PRESUPUESTO DE ANCHO DE BANDA ====================
+
+class DetectorFragmentos(yt_dlp.postprocessor.PostProcessor):
+    """Antes de descargar avisa a la cuota de si el formato elegido va por fragmentos"""
+    def __init__(self, cuota):
+        super().__init__()
+        self.cuota = cuota
+
+    def run(self, info):
+        formatos = info.get('requested_formats') or [info]
+        # http/https son descargas progresivas de una sola conexión; el resto (HLS, DASH...) son fragmentos
+        self.cuota.marcar_fragmentado(any(
+            f.get('protocol') not in (None, 'http', 'https') for f in formatos
+        ))
+        return [], info
+
+class CuotaDescarga:
+    """Conexiones y velocidad asignadas a un trabajo dentro del presupuesto global"""
+    def __init__(self, conexiones, especulativa=False):
+        self.conexiones = conexiones
+        # Las cuotas de prefetch reciben menos ancho de banda que los trabajos reales
+        self.especulativa = especulativa
+        self.limite_bytes = None
+        self.usa_aria2c = DESCARGA_ARIA2C and shutil.which("aria2c") is not None
+        # Solo las descargas por fragmentos usan varias conexiones con el descargador nativo
+        self.fragmentado = False
+        self.bytes = 0
+        self.segundos = 0.0
+        self._params = None
+
+    def limite_ytdlp(self):
+        """Valor de 'ratelimit': aria2c lo aplica al total, el descargador nativo por conexión"""
+        if not self.limite_bytes:
+            return None
+        if self.usa_aria2c or not self.fragmentado:
+            return int(self.limite_bytes)
+        return max(1, int(self.limite_bytes / self.conexiones))
+
+    def marcar_fragmentado(self, fragmentado):
+        self.fragmentado = fragmentado
+        if self._params is not None:
+            # Los fragmentos copian los params al empezar: hay que fijarlo antes
+            self._params['ratelimit'] = self.limite_ytdlp()
+
+    def opciones_ytdlp(self):
+        opciones = {'ratelimit': self.limite_ytdlp()}
+        if self.usa_aria2c:
+            # aria2c divide archivos progresivos en rangos (-x/-s) y baja fragmentos en paralelo (-j)
+            n = str(self.conexiones)
+            opciones['external_downloader'] = {'default': 'aria2c'}
+            opciones['external_downloader_args'] = {'aria2c': ['-x', n, '-s', n, '-j', n, '-k', '1M']}
+        else:
+            opciones['concurrent_fragment_downloads'] = self.conexiones
+            # Peticiones por rangos de 10MB: evita el throttling de conexiones largas
+            opciones['http_chunk_size'] = 10 * MB
+        return opciones
+
+    def una_conexion_cli(self, a_stdout=False):
+        """El CLI no dice de antemano si habrá fragmentos: con límite activo y sin aria2c una
+        sola conexión ya satura su parte, así que se usa una con el límite completo"""
+        # aria2c no puede escribir a stdout; en ese caso se usa el descargador nativo
+        return bool(self.limite_bytes) and not (self.usa_aria2c and not a_stdout)
+
+    def argumentos_cli(self, a_stdout=False):
+        """Argumentos equivalentes para el yt-dlp de línea de comandos"""
+        usa_aria2c = self.usa_aria2c and not a_stdout
+        if self.una_conexion_cli(a_stdout):
+            return ["-N", "1", "--limit-rate", str(max(1, int(self.limite_bytes)))]
+        argumentos = ["-N", str(self.conexiones)]
+        if self.limite_bytes:
+            argumentos += ["--limit-rate", str(max(1, int(self.limite_bytes)))]
+        if usa_aria2c:
+            n = str(self.conexiones)
+            argumentos += ["--downloader", "aria2c", "--downloader-args", f"aria2c:-x {n} -s {n} -j {n} -k 1M"]
+        return argumentos
+
+    def vincular(self, ydl):
+        """Enlaza los params vivos de YoutubeDL para poder reajustar el límite en caliente"""
+        self._params = ydl.params
+        self._params['ratelimit'] = self.limite_ytdlp()
+        ydl.add_post_processor(DetectorFragmentos(self), when='before_dl')
+
+    def desvincular(self):
+        self._params = None
+
+    def aplicar_limite(self, limite_bytes):
+        self.limite_bytes = limite_bytes
+        if self._params is not None:
+            # Las descargas HTTP nativas releen 'ratelimit' en cada bloque
+            self._params['ratelimit'] = self.limite_ytdlp()
+
+    def registrar_archivo(self, bytes_archivo, segundos):
+        self.bytes += bytes_archivo or 0
+        self.segundos += segundos or 0
+
+    def resumen(self):
+        if not self.bytes or not self.segundos:
+            return None
+        return (
+            f"🚀 Descarga: {self.bytes / MB:.1f}MB a {self.bytes / MB / self.segundos:.2f}MB/s "
+            f"({self.conexiones} conexiones)"
+        )
+
+class PresupuestoDescarga:
+    """Reparte de forma equitativa las conexiones y el ancho de banda entre trabajos activos"""
+    def __init__(self, conexiones_global, ancho_banda_bytes):
+        self.conexiones_global = conexiones_global
+        self.ancho_banda_bytes = ancho_banda_bytes
+        self.activas = []
+        self._condicion = asyncio.Condition()
+
+    def conexiones_libres(self):
+        return self.conexiones_global - sum(c.conexiones for c in self.activas)
+
+    async def asignar(self, especulativa=False, al_esperar=None):
+        """Las conexiones de una descarga en curso no se pueden cambiar, así que el total nunca
+        supera el presupuesto global: cada trabajo nuevo toma como mucho la mitad de las
+        libres (deja sitio a los siguientes) y espera si no queda ninguna.
+        Una cuota especulativa nunca espera: devuelve None si no sobran conexiones."""
+        if not especulativa and al_esperar and self.conexiones_libres() < 1:
+            # Avisar fuera del lock para no bloquear las liberaciones
+            await al_esperar()
+        async with self._condicion:
+            if especulativa:
+                # Una sola conexión y siempre dejando al menos otra para un trabajo real
+                if self.conexiones_libres() < 2:
+                    return None
+                conexiones = 1
+            else:
+                await self._condicion.wait_for(lambda: self.conexiones_libres() >= 1)
+                conexiones = max(1, min(DESCARGA_CONEXIONES_TRABAJO, self.conexiones_libres() // 2))
+            cuota = CuotaDescarga(conexiones, especulativa)
+            self.activas.append(cuota)
+            self._rebalancear()
+            return cuota
+
+    async def preparar_cli(self, cuota, a_stdout=False):
+        """Argumentos CLI de la cuota; si el CLI usará una sola conexión devuelve el resto al presupuesto"""
+        if cuota.una_conexion_cli(a_stdout) and cuota.conexiones > 1:
+            async with self._condicion:
+                cuota.conexiones = 1
+                self._condicion.notify_all()
+        return cuota.argumentos_cli(a_stdout)
+
+    async def liberar(self, cuota):
+        async with self._condicion:
+            if cuota in self.activas:
+                self.activas.remove(cuota)
+                self._rebalancear()
+                self._condicion.notify_all()
+
+    def _rebalancear(self):
+        """Cada trabajo activo recibe la misma parte del ancho de banda global; los prefetch, una fracción"""
+        if not self.ancho_banda_bytes or not self.activas:
+            return
+        pesos = [PREFETCH_PESO_ANCHO_BANDA if c.especulativa else 1 for c in self.activas]
+        unidad = self.ancho_banda_bytes / sum(pesos)
+        for cuota, peso in zip(self.activas, pesos):
+            cuota.aplicar_limite(unidad * peso)
+
+presupuesto_descarga = PresupuestoDescarga(DESCARGA_CONEXIONES_GLOBAL, DESCARGA_ANCHO_BANDA_KBPS * 1000 / 8)
+
+# ==================== JOURNAL DE TRABAJOS ====================
+
+class JournalTrabajos:
+    """Registro persistente de trabajos en curso para sobrevivir a reinicios"""
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.trabajos = {}
+        self._cargar()
+
+    def _cargar(self):
+        if not os.path.exists(self.ruta):
+            return
+        try:
+            with open(self.ruta, encoding='utf-8') as f:
+                self.trabajos = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Journal ilegible, se ignora ({self.ruta}): {e}")
+            self.trabajos = {}
+
+    def _guardar(self):
+        """Escritura atómica: un crash a mitad nunca deja el journal corrupto"""
+        try:
+            os.makedirs(os.path.dirname(self.ruta) or '.', exist_ok=True)
+            temporal = f"{self.ruta}.tmp"
+            with open(temporal, 'w', encoding='utf-8') as f:
+                json.dump(self.trabajos, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporal, self.ruta)
+        except OSError as e:
+            logger.error(f"Error guardando journal: {e}")
+
+    def registrar(self, **datos):
+        trabajo = {
+            'id': uuid.uuid4().hex[:12],
+            'etapa': 'descargando',
+            'staging': None,
+            'bytes_reservados': 0,
+            'enviados': [],
+            'intentos': 0,
+            'creado': datetime.now().isoformat(timespec='seconds'),
+            **datos,
+        }
+        self.trabajos[trabajo['id']] = trabajo
+        self._guardar()
+        return trabajo
+
+    def actualizar(self, trabajo_id, **campos):
+        trabajo = self.trabajos.get(trabajo_id)
+        if trabajo is None:
+            return
+        trabajo.update(campos)
+        self._guardar()
+
+    def eliminar(self, trabajo_id):
+        if self.trabajos.pop(trabajo_id, None) is not None:
+            self._guardar()
+
+    def pendientes(self):
+        return list(self.trabajos.values())
+
+    def rutas_staging(self):
+        return {t['staging'] for t in self.trabajos.values() if t.get('staging')}
+
+journal = JournalTrabajos(JOURNAL_PATH)
+
+# ==================== CANCELACIÓN Y PLAZOS ====================
+
+class DescargaCancelada(Exception):
+    """Se lanza desde un progress hook para detener una descarga de yt-dlp"""
+
+def matar_grupo(proceso):
+    """Mata un subproceso y todos sus hijos (se crean con start_new_session)"""
+    if proceso.returncode is not None:
+        return
+    try:
+        os.killpg(proceso.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    except OSError:
+        proceso.kill()
+
+def matar_hijos_en(ruta):
+    """Mata los procesos hijos (ffmpeg lanzado por yt-dlp) que trabajan sobre `ruta`"""
+    if not os.path.isdir('/proc'):
+        return
+    mi_pid = os.getpid()
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # El nombre del proceso va entre paréntesis y puede tener espacios
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            if ppid != mi_pid:
+                continue
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                if ruta.encode() not in f.read():
+                    continue
+            os.kill(int(pid), signal.SIGKILL)
+        except (OSError, ValueError, IndexError):
+            continue
+
+async def esperar_hilo_cancelado(futuro, ruta):
+    """Tras cancelar, espera a que el hilo de yt-dlp se detenga (el hook lo corta en el siguiente
+    bloque); si se borrara el staging antes, yt-dlp lo recrearía y dejaría un .part huérfano"""
+    try:
+        await asyncio.wait_for(asyncio.shield(futuro), timeout=ESPERA_HILO_CANCELADO)
+    except asyncio.TimeoutError:
+        logger.warning(f"El hilo de yt-dlp sigue activo tras cancelar; se limpiará al terminar: {ruta}")
+        futuro.add_done_callback(lambda _: shutil.rmtree(ruta, ignore_errors=True))
+    except Exception:
+        # El hilo terminó con DescargaCancelada u otro error: ya no escribe
+        pass
+
+def liberar_al_terminar(reserva, futuro):
+    """Libera una reserva cuando `futuro` (que aún escribe en ella) termine, no antes"""
+    futuro.add_done_callback(lambda _: asyncio.ensure_future(reserva.liberar()))
+
+async def crear_proceso(control, *comando, **kwargs):
+    """Lanza un subproceso en su propio grupo y lo asocia al trabajo para poder matarlo"""
+    proceso = await asyncio.create_subprocess_exec(*comando, start_new_session=True, **kwargs)
+    if control:
+        control.procesos.add(proceso)
+    return proceso
+
+class ControlTrabajo:
+    """Estado de cancelación de un trabajo en ejecución"""
+    def __init__(self, trabajo, tarea):
+        self.trabajo_id = trabajo['id']
+        self.usuario_id = trabajo.get('usuario_id')
+        self.tarea = tarea
+        # threading.Event: lo consultan los progress hooks desde el executor
+        self.cancelado = threading.Event()
+        self.motivo = None
+        self.procesos = set()
+        self.reserva = None
+        self._plazo = None
+
+    def plazo(self, segundos, etapa):
+        """Programa la cancelación del trabajo si la etapa no termina a tiempo"""
+        if self._plazo:
+            self._plazo.cancel()
+        self._plazo = asyncio.get_event_loop().call_later(
+            segundos, self.cancelar, f"tiempo límite de {etapa} ({segundos}s)"
+        )
+
+    def cancelar(self, motivo):
+        """Detiene el trabajo y libera procesos, hilos y staging"""
+        if self.cancelado.is_set():
+            return
+        self.motivo = motivo
+        self.cancelado.set()
+        logger.info(f"Cancelando trabajo {self.trabajo_id}: {motivo}")
+
+        for proceso in self.procesos:
+            matar_grupo(proceso)
+        if self.reserva:
+            # Cancelación explícita: el staging se borra aunque el trabajo esté en el journal
+            self.reserva.persistente = False
+            matar_hijos_en(self.reserva.ruta)
+        if self.tarea and not self.tarea.done():
+            self.tarea.cancel()
+
+    def plazo_vencido(self):
+        return self.cancelado.is_set() and (self.motivo or "").startswith("tiempo límite")
+
+    def finalizar(self):
+        if self._plazo:
+            self._plazo.cancel()
+
+# Trabajos en ejecución por id
+trabajos_activos = {}
+
 # ==================== FUNCIONES ORIGINALES ====================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -107,7 +723,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Comandos:\n"
         "• /info - Ver información de video/audio\n"
         "• /ayuda - Guía de uso completa\n"
-        "• /config - Verificar configuración del sistema"
+        "• /config - Verificar configuración del sistema\n"
+        "• /cancel - Cancelar tus descargas en curso"
     )
 
 async def ayuda(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -127,7 +744,8 @@ async def ayuda(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• MP4: Video completo (YouTube)\n"
         "• MP3: Audio comprimido\n"
         "• FLAC: Audio sin pérdida\n"
-        "• WAV: Audio sin comprimir\n\n"
+        "• WAV: Audio sin comprimir\n"
+        "• Original: Audio tal cual, sin recodificar\n\n"
         "📊 Información de progreso:\n"
         "• Tiempo por tarea individual\n"
         "• Progreso de descarga en %\n"
@@ -135,40 +753,213 @@ async def ayuda(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• Tiempo total del proceso\n\n"
         "ℹ️ Usa /info [URL] para ver detalles sin descargar\n"
         "🔧 Usa /config para verificar configuración del sistema\n"
+        "🛑 Usa /cancel o el botón Cancelar para detener una descarga\n"
         "❗Uso educativo únicamente"
     )
 
 # ==================== FUNCIONES YOUTUBE CON PROGRESO ====================
 
-def obtener_info_youtube(url):
-    """Obtiene información de un video de YouTube usando yt-dlp"""
-    ydl_opts = {'quiet': True, 'no_warnings': True}
+def resumir_info_youtube(info):
+    """Extrae de la info de yt-dlp los campos que usa el bot"""
+    return {
+        'titulo': info.get('title', 'N/A'),
+        'canal': info.get('uploader', 'N/A'),
+        'duracion': info.get('duration', 0),
+        'fecha': info.get('upload_date', 'N/A'),
+        'vistas': info.get('view_count', 0),
+        'descripcion': info.get('description', 'N/A')[:200] + '...' if info.get('description') else 'N/A',
+        'es_playlist': info.get('_type') == 'playlist',
+        'cantidad_videos': len(info.get('entries', [])) if info.get('_type') == 'playlist' else 1,
+        'tamaño_aprox': info.get('filesize') or info.get('filesize_approx', 0),
+        'duracion_total': sum((e or {}).get('duration') or 0 for e in info.get('entries') or []) if info.get('_type') == 'playlist' else info.get('duration', 0),
+        # Formatos solo-audio para que el planificador evite recodificar
+        'formatos_audio': [
+            {
+                'format_id': f['format_id'],
+                'acodec': f.get('acodec'),
+                'ext': f.get('ext'),
+                'abr': f.get('abr') or f.get('tbr') or 0,
+            }
+            for f in info.get('formats') or []
+            if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')
+        ]
+    }
 
+async def obtener_info_youtube(url, timeout=PLAZO_ANALISIS):
+    """Obtiene información de un video de YouTube usando yt-dlp.
+    Corre en un proceso aparte: al vencer el plazo se mata en vez de dejar un hilo colgado."""
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            return {
-                'titulo': info.get('title', 'N/A'),
-                'canal': info.get('uploader', 'N/A'),
-                'duracion': info.get('duration', 0),
-                'fecha': info.get('upload_date', 'N/A'),
-                'vistas': info.get('view_count', 0),
-                'descripcion': info.get('description', 'N/A')[:200] + '...' if info.get('description') else 'N/A',
-                'es_playlist': info.get('_type') == 'playlist',
-                'cantidad_videos': len(info.get('entries', [])) if info.get('_type') == 'playlist' else 1,
-                'tamaño_aprox': info.get('filesize') or info.get('filesize_approx', 0)
-            }
-    except Exception as e:
+        proceso = await crear_proceso(
+            None, "yt-dlp", "-J", "--no-warnings", url,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+    except OSError as e:
         logger.error(f"Error obteniendo info: {e}")
         return None
 
+    try:
+        stdout, stderr = await asyncio.wait_for(proceso.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"Tiempo límite de análisis ({timeout}s): {url}")
+        matar_grupo(proceso)
+        await proceso.wait()
+        return None
+    except asyncio.CancelledError:
+        matar_grupo(proceso)
+        raise
+
+    if proceso.returncode != 0:
+        logger.error(f"Error obteniendo info: {stderr.decode(errors='replace').strip()[-300:]}")
+        return None
+
+    try:
+        return resumir_info_youtube(json.loads(stdout))
+    except (ValueError, AttributeError, TypeError) as e:
+        logger.error(f"Error obteniendo info: {e}")
+        return None
+
+# Códec que debe tener la fuente para entregar cada formato sin recodificar
+CODEC_OBJETIVO = {'mp3': 'mp3', 'flac': 'flac', 'wav': 'pcm'}
+CODECS_SIN_PERDIDA = {'flac', 'alac', 'pcm'}
+# Contenedores que Telegram reproduce como audio tal cual se descargan
+EXTENSIONES_DIRECTAS = ('m4a', 'mp3')
+
+DESCRIPCION_MODO = {
+    'passthrough': "sin procesar (passthrough)",
+    'remux': "remux sin recodificar",
+    'transcodificacion': "transcodificado",
+}
+
+def normalizar_codec(acodec):
+    """Reduce los nombres de códec de yt-dlp (mp4a.40.2, pcm_s16le...) a una familia"""
+    if not acodec or acodec == 'none':
+        return None
+    acodec = acodec.lower()
+    if acodec in ('mp3', 'mp4a.40.34', 'mp4a.6b'):
+        return 'mp3'
+    if acodec.startswith('mp4a') or acodec == 'aac':
+        return 'aac'
+    if acodec.startswith('pcm'):
+        return 'pcm'
+    return acodec.split('.')[0]
+
+def _plan(formato, modo, selector, postprocessors=None, final_ext=None, nota=None):
+    return {
+        'formato': formato,
+        'modo': modo,
+        'selector': selector,
+        'postprocessors': postprocessors or [],
+        'final_ext': final_ext,
+        'nota': nota,
+        'ffmpeg_segundos': None,
+    }
+
+def _plan_original(formatos):
+    """Audio original: descarga directa si Telegram lo acepta, si no solo cambio de contenedor"""
+    mejor = max(formatos, key=lambda f: f.get('abr') or 0, default=None)
+    directos = [f for f in formatos if f['ext'] in EXTENSIONES_DIRECTAS]
+    directo = max(directos, key=lambda f: f.get('abr') or 0, default=None)
+
+    # Se prefiere el contenedor directo salvo que pierda más de un 10% de bitrate
+    if directo and (directo.get('abr') or 0) >= 0.9 * (mejor.get('abr') or 0):
+        return _plan('original', 'passthrough', f"{directo['format_id']}/bestaudio/best")
+    selector = f"{mejor['format_id']}/bestaudio/best" if mejor else "bestaudio/best"
+    return _plan('original', 'remux', selector, [{
+        'key': 'FFmpegExtractAudio',
+        'preferredcodec': 'best',
+    }])
+
+def planificar_formato(info, formato):
+    """Elige la fuente y el procesamiento mínimo para entregar `formato`"""
+    if formato == "mp4":
+        return _plan('mp4', 'passthrough', 'best[height<=720]/best')
+
+    formatos = (info or {}).get('formatos_audio') or []
+    mejor = max(formatos, key=lambda f: f.get('abr') or 0, default=None)
+
+    if formato == "original":
+        return _plan_original(formatos)
+
+    # Si existe una fuente con el códec pedido basta con copiar el stream
+    coincidentes = [f for f in formatos if normalizar_codec(f['acodec']) == CODEC_OBJETIVO[formato]]
+    if coincidentes:
+        fuente = max(coincidentes, key=lambda f: f.get('abr') or 0)
+        selector = f"{fuente['format_id']}/bestaudio/best"
+        if fuente['ext'] == formato:
+            return _plan(formato, 'passthrough', selector)
+        # FFmpegExtractAudio usa "-acodec copy" cuando el códec de ffprobe se llama como el
+        # formato; en WAV ffprobe informa pcm_s16le, así que siempre acaba recodificando
+        if formato != 'wav':
+            return _plan(formato, 'remux', selector, [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': formato,
+            }], final_ext=formato)
+
+    # Sin pérdida desde una fuente con pérdida solo infla el archivo
+    if formato in ('flac', 'wav') and mejor and normalizar_codec(mejor['acodec']) not in CODECS_SIN_PERDIDA:
+        # Telegram limita cada archivo: en playlists cuenta la duración media por pista
+        duracion = (info.get('duracion_total') or info.get('duracion') or 0) / (info.get('cantidad_videos') or 1)
+        salida = duracion * BITRATES_SALIDA_KBPS[formato] * 1000 / 8
+        if salida > LIMITE_ENVIO_MB * MB:
+            plan = _plan_original(formatos)
+            plan['nota'] = (
+                f"⚠️ {formato.upper()} desde una fuente {normalizar_codec(mejor['acodec'])} ocuparía "
+                f"~{salida / MB:.0f}MB (límite {LIMITE_ENVIO_MB}MB): se entrega el audio original"
+            )
+            return plan
+
+    return _plan(formato, 'transcodificacion', 'bestaudio/best', [{
+        'key': 'FFmpegExtractAudio',
+        'preferredcodec': formato,
+        'preferredquality': '192' if formato == 'mp3' else '0',
+    }], final_ext=formato)
+
+class EstadisticasCodificacion:
+    """Cuenta cómo se entregó cada audio y estima el CPU ahorrado al no recodificar"""
+    def __init__(self):
+        # Segundos de CPU por segundo de audio; se recalibran con el tiempo medido de ffmpeg
+        self.cpu_por_segundo = {'mp3': 0.02, 'flac': 0.01, 'wav': 0.004}
+        self.entregas = {modo: 0 for modo in DESCRIPCION_MODO}
+        self.cpu_ahorrado = 0.0
+
+    def registrar(self, plan, duracion):
+        """Registra una entrega y devuelve los segundos de CPU ahorrados"""
+        self.entregas[plan['modo']] += 1
+
+        if plan['modo'] == 'transcodificacion':
+            if duracion and plan['ffmpeg_segundos']:
+                previo = self.cpu_por_segundo.get(plan['formato'], self.cpu_por_segundo['mp3'])
+                self.cpu_por_segundo[plan['formato']] = 0.8 * previo + 0.2 * plan['ffmpeg_segundos'] / duracion
+            return 0.0
+
+        # "original" se compara con la conversión por defecto a MP3
+        ahorrado = (duracion or 0) * self.cpu_por_segundo.get(plan['formato'], self.cpu_por_segundo['mp3'])
+        self.cpu_ahorrado += ahorrado
+        logger.info(
+            f"Entrega {plan['modo']} ({plan['formato']}): ~{ahorrado:.1f}s CPU ahorrados "
+            f"(total {self.cpu_ahorrado:.1f}s)"
+        )
+        return ahorrado
+
+estadisticas_codificacion = EstadisticasCodificacion()
+
 class ProgressHook:
     """Clase helper para manejar el progreso de manera sincronizada"""
-    def __init__(self, tracker):
+    def __init__(self, tracker, cuota=None, control=None):
         self.tracker = tracker
+        self.cuota = cuota
+        self.control = control
         self.loop = asyncio.get_event_loop()
 
     def __call__(self, d):
+        if self.control and self.control.cancelado.is_set():
+            # Única forma de interrumpir a yt-dlp dentro del executor
+            raise DescargaCancelada(self.control.motivo)
+
+        if d['status'] == 'finished' and self.cuota:
+            self.cuota.registrar_archivo(d.get('total_bytes') or d.get('downloaded_bytes'), d.get('elapsed'))
+
         if d['status'] == 'downloading':
             # Programar actualización de progreso
             self.loop.call_soon_threadsafe(
@@ -204,39 +995,51 @@ class ProgressHook:
         except Exception as e:
             logger.error(f"Error actualizando progreso: {e}")
 
-async def descargar_youtube_con_progreso(url, formato, directorio_temp, tracker):
+async def descargar_youtube_con_progreso(url, formato, directorio_temp, tracker, plan=None, cuota=None, control=None, errores=None):
     """Descarga video/audio de YouTube con seguimiento de progreso"""
+    if plan is None:
+        plan = planificar_formato(None, formato)
 
     try:
         await tracker.start_task("Analizando video")
 
         # Crear hook de progreso
-        progress_hook = ProgressHook(tracker)
-
-        # Configurar opciones según formato
+        progress_hook = ProgressHook(tracker, cuota, control)
+
+        # Tiempo de ffmpeg medido solo en este trabajo: RUSAGE_CHILDREN mezclaría el ffmpeg de
+        # otros trabajos concurrentes y aria2c. Los códecs de audio son de un solo hilo, así
+        # que su tiempo real se aproxima a su CPU.
+        medicion_ffmpeg = {'inicio': None, 'segundos': 0.0}
+
+        def medir_ffmpeg(d):
+            if d.get('postprocessor') != 'ExtractAudio':
+                return
+            if d['status'] == 'started':
+                medicion_ffmpeg['inicio'] = time.monotonic()
+            elif d['status'] == 'finished' and medicion_ffmpeg['inicio'] is not None:
+                medicion_ffmpeg['segundos'] += time.monotonic() - medicion_ffmpeg['inicio']
+                medicion_ffmpeg['inicio'] = None
+
+        # Configurar opciones según el plan de formato
         if formato == "mp4":
             await tracker.update_progress("Configurando descarga de video...")
-            ydl_opts = {
-                'format': 'best[height<=720]/best',
-                'outtmpl': f'{directorio_temp}/%(title)s.%(ext)s',
-                'quiet': True,
-                'no_warnings': True,
-                'progress_hooks': [progress_hook],
-            }
-        else:  # MP3, FLAC, WAV
-            await tracker.update_progress("Configurando extracción de audio...")
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'outtmpl': f'{directorio_temp}/%(title)s.%(ext)s',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': formato,
-                    'preferredquality': '192' if formato == 'mp3' else '0',
-                }],
-                'quiet': True,
-                'no_warnings': True,
-                'progress_hooks': [progress_hook],
-            }
+        else:  # MP3, FLAC, WAV, original
+            await tracker.update_progress(f"Configurando audio: {DESCRIPCION_MODO[plan['modo']]}...")
+
+        ydl_opts = {
+            'format': plan['selector'],
+            'outtmpl': f'{directorio_temp}/%(title)s.%(ext)s',
+            'postprocessors': plan['postprocessors'],
+            'quiet': True,
+            'no_warnings': True,
+            'progress_hooks': [progress_hook],
+            'postprocessor_hooks': [medir_ffmpeg],
+        }
+        if cuota:
+            ydl_opts.update(cuota.opciones_ytdlp())
+        if plan['final_ext']:
+            # Permite a yt-dlp saltar la descarga si el audio final ya existe (trabajo reanudado)
+            ydl_opts['final_ext'] = plan['final_ext']
 
         await tracker.start_task("Iniciando descarga")
 
@@ -245,11 +1048,26 @@ async def descargar_youtube_con_progreso(url, formato, directorio_temp, tracker)
 
         def download_sync():
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-
-        await loop.run_in_executor(None, download_sync)
-
-        if formato != "mp4":
+                if cuota:
+                    cuota.vincular(ydl)
+                try:
+                    ydl.download([url])
+                finally:
+                    if cuota:
+                        cuota.desvincular()
+            plan['ffmpeg_segundos'] = medicion_ffmpeg['segundos']
+
+        futuro = loop.run_in_executor(None, download_sync)
+        try:
+            # shield: cancelar la tarea no debe soltar el futuro del hilo, que sigue vivo
+            await asyncio.shield(futuro)
+        except asyncio.CancelledError:
+            # En un apagado el staging se conserva; solo una cancelación explícita lo borra
+            if control and control.cancelado.is_set():
+                await esperar_hilo_cancelado(futuro, directorio_temp)
+            raise
+
+        if plan['postprocessors']:
             await tracker.start_task("Convirtiendo audio")
             await asyncio.sleep(1)  # Simular tiempo de conversión
 
@@ -257,6 +1075,7 @@ async def descargar_youtube_con_progreso(url, formato, directorio_temp, tracker)
 
     except Exception as e:
         logger.error(f"Error descargando YouTube: {e}")
+        anotar_error(errores, str(e))
         return False
 
 async def verificar_spotdl():
@@ -272,7 +1091,7 @@ async def verificar_spotdl():
     except FileNotFoundError:
         return False
 
-async def descargar_spotify_con_progreso(url, directorio_temp, tracker):
+async def descargar_spotify_con_progreso(url, directorio_temp, tracker, control=None, errores=None):
     """Descarga de Spotify con seguimiento de progreso"""
     try:
         await tracker.start_task("Verificando Spotify")
@@ -281,6 +1100,7 @@ async def descargar_spotify_con_progreso(url, directorio_temp, tracker):
         if not await verificar_spotdl():
             logger.error("spotdl no está instalado o configurado")
             await tracker.update_progress("❌ spotdl no disponible")
+            anotar_error(errores, "spotdl no disponible")
             return False
 
         await tracker.start_task("Descargando desde Spotify")
@@ -299,7 +1119,8 @@ async def descargar_spotify_con_progreso(url, directorio_temp, tracker):
         logger.info(f"Comando Spotify: {' '.join(comando)}")
 
         # Ejecutar comando con timeout
-        proceso = await asyncio.create_subprocess_exec(
+        proceso = await crear_proceso(
+            control,
             *comando,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE
@@ -317,9 +1138,11 @@ async def descargar_spotify_con_progreso(url, directorio_temp, tracker):
                 timeout=300
             )
         except asyncio.TimeoutError:
-            proceso.kill()
+            # spotdl lanza sus propios ffmpeg/yt-dlp: matar todo el grupo
+            matar_grupo(proceso)
             logger.error("Timeout en descarga de Spotify")
             await tracker.update_progress("❌ Timeout en descarga")
+            anotar_error(errores, "timeout")
             return False
 
         stdout_text = stdout.decode('utf-8', errors='ignore')
@@ -341,14 +1164,20 @@ async def descargar_spotify_con_progreso(url, directorio_temp, tracker):
         else:
             logger.error(f"Error Spotify (código {proceso.returncode}): {stderr_text}")
             await tracker.update_progress(f"❌ Error: {stderr_text[:100]}")
+            anotar_error(errores, stderr_text)
             return False
 
     except Exception as e:
         logger.error(f"Error descargando Spotify: {e}")
         await tracker.update_progress(f"❌ Error: {str(e)[:100]}")
+        anotar_error(errores, str(e))
         return False
 
-async def descargar_otros_con_progreso(url, formato, directorio_temp, tracker):
+PLANTILLA_PROGRESO_CLI = (
+    "download:PROGRESO_CLI %(progress.status)s %(progress.downloaded_bytes)s %(progress.elapsed)s"
+)
+
+async def descargar_otros_con_progreso(url, formato, directorio_temp, tracker, cuota=None, control=None, errores=None):
     """Descarga de SoundCloud/Bandcamp con seguimiento de progreso"""
     try:
         await tracker.start_task("Descargando desde plataforma musical")
@@ -361,12 +1190,18 @@ async def descargar_otros_con_progreso(url, formato, directorio_temp, tracker):
         else:
             comando = [
                 "yt-dlp", "-o", f"{directorio_temp}/%(title)s.%(ext)s",
-                "--extract-audio", "--audio-format", formato, url
+                "--extract-audio", "--audio-format", "best" if formato == "original" else formato, url
             ]
 
+        if cuota:
+            comando[1:1] = await presupuesto_descarga.preparar_cli(cuota)
+        # Bytes y tiempo de cada descarga terminada, sin contar la conversión posterior
+        comando[1:1] = ["--newline", "--progress-template", PLANTILLA_PROGRESO_CLI]
+
         await tracker.update_progress("Iniciando descarga...")
 
-        proceso = await asyncio.create_subprocess_exec(
+        proceso = await crear_proceso(
+            control,
             *comando,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE
@@ -376,14 +1211,765 @@ async def descargar_otros_con_progreso(url, formato, directorio_temp, tracker):
 
         if proceso.returncode == 0:
             await tracker.update_progress("Descarga completada")
+            if cuota:
+                for linea in stdout.decode(errors='replace').splitlines():
+                    partes = linea.split()
+                    if len(partes) == 4 and partes[:2] == ["PROGRESO_CLI", "finished"]:
+                        try:
+                            cuota.registrar_archivo(int(partes[2]), float(partes[3]))
+                        except ValueError:
+                            # "NA" cuando el archivo ya estaba descargado
+                            pass
             return True
         else:
             logger.error(f"Error otros: {stderr.decode()}")
+            anotar_error(errores, stderr.decode(errors='replace'))
             return False
 
     except Exception as e:
         logger.error(f"Error descargando otros: {e}")
+        anotar_error(errores, str(e))
+        return False
+
+# ==================== CIRCUIT BREAKERS Y RUTAS DE DESCARGA ====================
+
+PLATAFORMAS = {
+    'youtube': ("youtu.be", "youtube.com"),
+    'spotify': ("spotify.com",),
+    'soundcloud': ("soundcloud.com",),
+    'bandcamp': ("bandcamp.com",),
+}
+
+def normalizar_url(texto):
+    """Extrae el enlace de un mensaje y le añade el esquema si falta ("youtu.be/x")"""
+    palabras = [p.strip("<>()[]\"'") for p in texto.split()]
+    candidatas = [p for p in palabras if "://" in p] or [p for p in palabras if "." in p and "/" in p]
+    url = candidatas[0] if candidatas else texto.strip()
+    if "://" not in url:
+        url = "https://" + url
+    return url
+
+def plataforma_de(url):
+    """Nombre de la plataforma de un enlace; las demás comparten el circuito 'otras'"""
+    dominio = urllib.parse.urlparse(normalizar_url(url)).netloc.lower()
+    for nombre, dominios in PLATAFORMAS.items():
+        # Se compara el dominio real: "a.com/youtube.com" no debe contar como YouTube
+        if any(dominio == d or dominio.endswith("." + d) for d in dominios):
+            return nombre
+    return "otras"
+
+# Errores que indican un upstream o motor caído; privados, borrados, bloqueos por región o
+# enlaces mal formados son problemas del contenido y no deben abrir el circuito
+PATRONES_FALLO_CONTENIDO = (
+    "private video", "video unavailable", "this video is not available", "has been removed",
+    "in your country", "geo restrict", "geo-restrict", "unsupported url", "is not a valid url",
+    "confirm your age", "members-only", "members only", "copyright", "does not exist",
+    "http error 404",
+)
+PATRONES_FALLO_UPSTREAM = (
+    "timeout", "timed out", "http error 5", "http error 429", "too many requests",
+    "connection", "name resolution", "network is unreachable", "unable to extract",
+    "nsig extraction failed", "not a bot", "unable to download webpage",
+    "unable to download api page", "spotdl no disponible",
+)
+
+def anotar_error(errores, mensaje):
+    if errores is not None and mensaje:
+        errores.append(mensaje)
+
+def es_fallo_upstream(mensaje):
+    mensaje = mensaje.lower()
+    if any(p in mensaje for p in PATRONES_FALLO_CONTENIDO):
+        return False
+    return any(p in mensaje for p in PATRONES_FALLO_UPSTREAM)
+
+class CircuitBreaker:
+    """Deja de llamar a un upstream que falla y lo sondea hasta que se recupera"""
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self.estado = 'cerrado'
+        # (timestamp, fallo, latencia) dentro de la ventana móvil
+        self.llamadas = deque()
+        self.abierto_desde = 0
+        self.sonda_en_curso = False
+
+    def _purgar(self):
+        limite = time.time() - CIRCUITO_VENTANA
+        while self.llamadas and self.llamadas[0][0] < limite:
+            self.llamadas.popleft()
+
+    def tasa_error(self):
+        self._purgar()
+        if not self.llamadas:
+            return 0.0
+        return sum(1 for _, fallo, _ in self.llamadas if fallo) / len(self.llamadas)
+
+    def latencia_media(self):
+        self._purgar()
+        if not self.llamadas:
+            return 0.0
+        return sum(latencia for _, _, latencia in self.llamadas) / len(self.llamadas)
+
+    def segundos_para_sonda(self):
+        if self.estado != 'abierto':
+            return 0
+        return max(0, self.abierto_desde + CIRCUITO_APERTURA - time.time())
+
+    def disponible(self):
+        """Consulta sin consumir la sonda del estado semiabierto"""
+        if self.estado == 'abierto':
+            return self.segundos_para_sonda() == 0
+        if self.estado == 'semiabierto':
+            return not self.sonda_en_curso
+        return True
+
+    def permitir(self):
+        """Autoriza una llamada; en semiabierto solo deja pasar una sonda a la vez"""
+        if self.estado == 'abierto':
+            if self.segundos_para_sonda() > 0:
+                return False
+            self.estado = 'semiabierto'
+            self.sonda_en_curso = False
+            logger.info(f"Circuito {self.nombre} semiabierto: enviando sonda")
+        if self.estado == 'semiabierto':
+            if self.sonda_en_curso:
+                return False
+            self.sonda_en_curso = True
+        return True
+
+    def registrar(self, fallo, latencia):
+        """Solo se registran fallos del upstream (errores de red o del motor, plazos vencidos)"""
+        if self.estado == 'semiabierto':
+            self.sonda_en_curso = False
+            if fallo:
+                self._abrir("la sonda falló")
+            else:
+                self.estado = 'cerrado'
+                self.llamadas.clear()
+                logger.info(f"Circuito {self.nombre} cerrado: upstream recuperado")
+            return
+
+        self.llamadas.append((time.time(), fallo, latencia))
+        tasa = self.tasa_error()
+        if (self.estado == 'cerrado' and len(self.llamadas) >= CIRCUITO_MIN_LLAMADAS
+                and tasa >= CIRCUITO_UMBRAL_ERROR):
+            self._abrir(f"{tasa:.0%} de errores en {len(self.llamadas)} llamadas")
+
+    def liberar(self):
+        """La llamada se canceló sin resultado: no cuenta, pero libera la sonda"""
+        if self.estado == 'semiabierto':
+            self.sonda_en_curso = False
+
+    def _abrir(self, motivo):
+        self.estado = 'abierto'
+        self.abierto_desde = time.time()
+        logger.warning(f"Circuito {self.nombre} abierto ({motivo}) durante {CIRCUITO_APERTURA}s")
+
+    def descripcion(self):
+        iconos = {'cerrado': '🟢', 'semiabierto': '🟡', 'abierto': '🔴'}
+        texto = (
+            f"{iconos[self.estado]} {self.nombre}: {self.estado} • "
+            f"{self.tasa_error():.0%} errores • {self.latencia_media():.1f}s"
+        )
+        if self.estado == 'abierto':
+            texto += f" • sonda en {self.segundos_para_sonda():.0f}s"
+        return texto
+
+# Circuitos por motor ("motor:spotdl") y por plataforma ("plataforma:youtube")
+circuitos = {}
+
+def obtener_circuito(nombre):
+    if nombre not in circuitos:
+        circuitos[nombre] = CircuitBreaker(nombre)
+    return circuitos[nombre]
+
+def circuitos_disponibles(motor, plataforma):
+    return (obtener_circuito(f"motor:{motor}").disponible()
+            and obtener_circuito(f"plataforma:{plataforma}").disponible())
+
+def obtener_titulo_spotify(url):
+    """Título de un track de Spotify vía oEmbed, para buscarlo en YouTube"""
+    try:
+        consulta = urllib.parse.urlencode({'url': url})
+        with urllib.request.urlopen(f"https://open.spotify.com/oembed?{consulta}", timeout=10) as respuesta:
+            return json.load(respuesta).get('title')
+    except Exception as e:
+        logger.error(f"Error obteniendo título de Spotify: {e}")
+        return None
+
+def rutas_descarga(url, formato, directorio_temp, tracker, plan, cuota, control):
+    """Motores candidatos para un enlace, en orden de preferencia"""
+    plataforma = plataforma_de(url)
+
+    if plataforma == 'spotify':
+        rutas = [{
+            'motor': 'spotdl',
+            'plataforma': 'spotify',
+            'descripcion': "spotdl",
+            'ejecutar': lambda errores: descargar_spotify_con_progreso(
+                url, directorio_temp, tracker, control=control, errores=errores
+            ),
+        }]
+
+        async def buscar_en_youtube(errores):
+            loop = asyncio.get_event_loop()
+            titulo = await loop.run_in_executor(None, obtener_titulo_spotify, url)
+            if not titulo:
+                # Sin título yt-dlp no llega a ejecutarse: la ruta no cuenta
+                return None
+            await tracker.update_progress(f"Buscando en YouTube: {titulo}")
+            return await descargar_youtube_con_progreso(
+                f"ytsearch1:{titulo}", formato, directorio_temp, tracker,
+                cuota=cuota, control=control, errores=errores
+            )
+
+        # La búsqueda por título solo tiene sentido para un track individual
+        if "/track/" in url:
+            rutas.append({
+                'motor': 'yt-dlp',
+                'plataforma': 'youtube',
+                'descripcion': "búsqueda en YouTube",
+                'ejecutar': buscar_en_youtube,
+            })
+        return rutas
+
+    en_proceso = {
+        'motor': 'yt-dlp',
+        'plataforma': plataforma,
+        'descripcion': "yt-dlp",
+        'ejecutar': lambda errores: descargar_youtube_con_progreso(
+            url, formato, directorio_temp, tracker, plan=plan, cuota=cuota, control=control, errores=errores
+        ),
+    }
+    linea_comandos = {
+        'motor': 'yt-dlp-cli',
+        'plataforma': plataforma,
+        'descripcion': "yt-dlp CLI",
+        'ejecutar': lambda errores: descargar_otros_con_progreso(
+            url, formato, directorio_temp, tracker, cuota=cuota, control=control, errores=errores
+        ),
+    }
+    if plataforma == 'youtube':
+        return [en_proceso, linea_comandos]
+    return [linea_comandos, en_proceso]
+
+async def descargar_con_rutas(rutas, tracker, control=None):
+    """Prueba en orden las rutas cuyos circuitos están cerrados.
+    Devuelve la ruta que funcionó (o None), las que se intentaron y los circuitos que bloquearon."""
+    intentadas = []
+    bloqueos = []
+    # Cada trabajo cuenta una sola vez por plataforma aunque pruebe varias rutas en ella:
+    # plataforma -> [fallo (None si no hubo fallo atribuible), segundos]
+    plataformas = {}
+    # Plataformas donde el enlace falló por su contenido
+    agotadas = set()
+
+    try:
+        for ruta in rutas:
+            if ruta['plataforma'] in agotadas:
+                continue
+            motor = obtener_circuito(f"motor:{ruta['motor']}")
+            nuevos = [motor]
+            if ruta['plataforma'] not in plataformas:
+                nuevos.append(obtener_circuito(f"plataforma:{ruta['plataforma']}"))
+
+            abiertos = [c for c in nuevos if not c.disponible()]
+            if abiertos:
+                logger.info(f"Ruta {ruta['descripcion']} omitida: {', '.join(c.nombre for c in abiertos)} abierto")
+                bloqueos.extend(abiertos)
+                continue
+
+            for circuito in nuevos:
+                circuito.permitir()
+            resultado_plataforma = plataformas.setdefault(ruta['plataforma'], [None, 0.0])
+
+            if intentadas:
+                await tracker.start_task(f"Ruta alternativa: {ruta['descripcion']}")
+
+            errores = []
+            inicio = time.time()
+            try:
+                exito = await ruta['ejecutar'](errores)
+            except asyncio.CancelledError:
+                if control and control.plazo_vencido():
+                    # Un plazo vencido es un timeout del upstream
+                    motor.registrar(True, time.time() - inicio)
+                    resultado_plataforma[0] = True
+                else:
+                    motor.liberar()
+                raise
+            latencia = time.time() - inicio
+            resultado_plataforma[1] += latencia
+
+            if exito is None:
+                # La ruta no llegó a usar el motor
+                motor.liberar()
+                continue
+            intentadas.append(ruta)
+
+            if exito:
+                motor.registrar(False, latencia)
+                resultado_plataforma[0] = False
+                return ruta, intentadas, bloqueos
+
+            if any(es_fallo_upstream(e) for e in errores):
+                motor.registrar(True, latencia)
+                resultado_plataforma[0] = True
+            else:
+                # Error del contenido: el upstream respondió, no dice nada de su salud, y otro
+                # motor fallaría igual con el mismo enlace (buscar en otra plataforma sí sirve)
+                motor.liberar()
+                logger.info(f"Error de contenido en {ruta['descripcion']}: no se reintenta en {ruta['plataforma']}")
+                agotadas.add(ruta['plataforma'])
+
+        return None, intentadas, bloqueos
+    finally:
+        for nombre, (fallo, segundos) in plataformas.items():
+            circuito = obtener_circuito(f"plataforma:{nombre}")
+            if fallo is None:
+                circuito.liberar()
+            else:
+                circuito.registrar(fallo, segundos)
+
+# ==================== STREAMING SIN DISCO ====================
+
+FORMATOS_STREAMING = {
+    # tamaño_conocido: el contenedor necesita el tamaño final en la cabecera
+    'mp3': {
+        'args': ['-codec:a', 'libmp3lame', '-b:a', '192k', '-f', 'mp3'],
+        'mime': 'audio/mpeg',
+        'tamaño_conocido': False,
+    },
+    'flac': {
+        # Un STREAMINFO sin total de muestras es válido según la especificación FLAC
+        'args': ['-codec:a', 'flac', '-f', 'flac'],
+        'mime': 'audio/flac',
+        'tamaño_conocido': False,
+    },
+    'wav': {
+        'args': ['-codec:a', 'pcm_s16le', '-f', 'wav'],
+        'mime': 'audio/wav',
+        'tamaño_conocido': True,
+    },
+}
+
+class StreamingError(Exception):
+    """Fallo en el pipeline de streaming; se puede reintentar con descarga a disco"""
+
+def puede_transmitir(formato, info):
+    """Indica si el trabajo puede ir por el pipeline de streaming sin disco"""
+    if not STREAMING_HABILITADO or formato not in FORMATOS_STREAMING:
+        return False
+    if not info or info['es_playlist'] or not info.get('duracion'):
         return False
+    salida = info['duracion'] * BITRATES_SALIDA_KBPS[formato] * 1000 / 8
+    return salida <= LIMITE_ENVIO_MB * MB
+
+def corregir_cabecera_wav(datos):
+    """Rellena los tamaños RIFF/data que ffmpeg no puede escribir en un pipe"""
+    if datos[:4] != b'RIFF' or datos[8:12] != b'WAVE':
+        return datos
+
+    struct.pack_into('<I', datos, 4, len(datos) - 8)
+    pos = 12
+    while pos + 8 <= len(datos):
+        chunk_id = bytes(datos[pos:pos + 4])
+        if chunk_id == b'data':
+            struct.pack_into('<I', datos, pos + 4, len(datos) - pos - 8)
+            break
+        tamaño_chunk = struct.unpack_from('<I', datos, pos + 4)[0]
+        pos += 8 + tamaño_chunk + (tamaño_chunk & 1)
+    return datos
+
+def _campo_multipart(boundary, nombre, valor):
+    return (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{nombre}"\r\n\r\n'
+        f'{valor}\r\n'
+    ).encode('utf-8')
+
+async def _bombear(lector, escritor):
+    """Copia bytes entre procesos respetando la contrapresión del destino"""
+    try:
+        while True:
+            chunk = await lector.read(STREAMING_CHUNK_KB * 1024)
+            if not chunk:
+                break
+            escritor.write(chunk)
+            await escritor.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg terminó antes de consumir toda la fuente
+        pass
+    finally:
+        try:
+            escritor.close()
+        except Exception:
+            pass
+
+async def _leer_stderr(proceso):
+    return (await proceso.stderr.read()).decode('utf-8', errors='ignore')
+
+async def _subir_audio_streaming(bot, chat_id, cola, verificar, nombre_archivo, formato, info, tracker):
+    """Sube el audio con un cuerpo multipart por chunks a medida que ffmpeg lo produce"""
+    boundary = f"musicbot{os.urandom(8).hex()}"
+    enviado = 0
+
+    async def cuerpo():
+        nonlocal enviado
+        yield _campo_multipart(boundary, 'chat_id', chat_id)
+        yield _campo_multipart(boundary, 'title', info['titulo'])
+        yield _campo_multipart(boundary, 'duration', int(info['duracion']))
+        yield (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="audio"; '
+            f'filename="{nombre_archivo.replace(chr(34), "%22")}"\r\n'
+            f'Content-Type: {FORMATOS_STREAMING[formato]["mime"]}\r\n\r\n'
+        ).encode('utf-8')
+
+        while True:
+            chunk = await cola.get()
+            if chunk is None:
+                break
+            enviado += len(chunk)
+            if enviado > LIMITE_ENVIO_MB * MB:
+                raise StreamingError(f"el audio supera {LIMITE_ENVIO_MB}MB")
+            yield chunk
+            await tracker.update_progress(f"📡 Transmitido: {enviado / MB:.1f}MB")
+
+        # Si la fuente o ffmpeg fallaron, abortar antes de cerrar el multipart
+        # para que Telegram no publique un audio truncado
+        await verificar()
+
+        # El caption va después del archivo porque solo ahora se conoce el tamaño
+        yield b'\r\n'
+        yield _campo_multipart(
+            boundary, 'caption',
+            f"🎵 {nombre_archivo}\n🎯 {formato.upper()} • {enviado / MB:.1f}MB"
+        )
+        yield f'--{boundary}--\r\n'.encode('utf-8')
+
+    async with httpx.AsyncClient(timeout=httpx.Timeout(60, write=None)) as cliente:
+        respuesta = await cliente.post(
+            f"{bot.base_url}/sendAudio",
+            content=cuerpo(),
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
+        )
+
+    datos = respuesta.json()
+    if not datos.get('ok'):
+        raise StreamingError(f"Telegram rechazó el audio: {datos.get('description')}")
+    return enviado
+
+async def _subir_audio_en_memoria(bot, chat_id, cola, verificar, nombre_archivo, formato, info, tracker):
+    """Acumula en memoria los formatos que necesitan tamaño conocido, corrige la cabecera y sube"""
+    datos = bytearray()
+    while True:
+        chunk = await cola.get()
+        if chunk is None:
+            break
+        datos.extend(chunk)
+        if len(datos) > LIMITE_ENVIO_MB * MB:
+            raise StreamingError(f"el audio supera {LIMITE_ENVIO_MB}MB")
+        await tracker.update_progress(f"🧠 En memoria: {len(datos) / MB:.1f}MB")
+
+    await verificar()
+    if formato == 'wav':
+        corregir_cabecera_wav(datos)
+
+    await tracker.start_task("Enviando archivos")
+    await bot.send_audio(
+        chat_id=chat_id,
+        audio=bytes(datos),
+        filename=nombre_archivo,
+        title=info['titulo'],
+        duration=int(info['duracion']),
+        caption=f"🎵 {nombre_archivo}\n🎯 {formato.upper()} • {len(datos) / MB:.1f}MB"
+    )
+    return len(datos)
+
+async def transmitir_audio(bot, chat_id, url, formato, info, tracker, cuota=None, control=None):
+    """Descarga, convierte y sube un audio sin tocar el disco: yt-dlp | ffmpeg | upload"""
+    await tracker.start_task("Transmitiendo audio (sin disco)")
+
+    inicio = time.time()
+    argumentos_red = await presupuesto_descarga.preparar_cli(cuota, a_stdout=True) if cuota else []
+    origen = await crear_proceso(
+        control,
+        "yt-dlp", "-f", "bestaudio/best", "-o", "-", "--quiet", "--no-warnings", *argumentos_red, url,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    conversor = await crear_proceso(
+        control,
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-i", "pipe:0", "-vn", *FORMATOS_STREAMING[formato]['args'], "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+
+    # Buffer acotado entre ffmpeg y la subida: si Telegram va lento, ffmpeg se frena
+    cola = asyncio.Queue(maxsize=STREAMING_BUFFER_CHUNKS)
+
+    async def producir():
+        try:
+            while True:
+                chunk = await conversor.stdout.read(STREAMING_CHUNK_KB * 1024)
+                if not chunk:
+                    break
+                await cola.put(chunk)
+        except Exception as e:
+            logger.error(f"Error leyendo salida de ffmpeg: {e}")
+        await cola.put(None)
+
+    titulo = "".join(c for c in info['titulo'] if c not in '/\\\0').strip() or "audio"
+    nombre_archivo = f"{titulo}.{formato}"
+    subir = _subir_audio_en_memoria if FORMATOS_STREAMING[formato]['tamaño_conocido'] else _subir_audio_streaming
+
+    tareas = [
+        asyncio.create_task(_bombear(origen.stdout, conversor.stdin)),
+        asyncio.create_task(producir()),
+    ]
+    errores_origen = asyncio.create_task(_leer_stderr(origen))
+    errores_conversor = asyncio.create_task(_leer_stderr(conversor))
+
+    async def verificar():
+        await asyncio.gather(*tareas)
+        await origen.wait()
+        await conversor.wait()
+        if origen.returncode != 0:
+            raise StreamingError(f"yt-dlp terminó con código {origen.returncode}: {(await errores_origen)[:200]}")
+        if conversor.returncode != 0:
+            raise StreamingError(f"ffmpeg terminó con código {conversor.returncode}: {(await errores_conversor)[:200]}")
+
+    try:
+        enviado = await subir(bot, chat_id, cola, verificar, nombre_archivo, formato, info, tracker)
+        logger.info(f"Streaming completado: {nombre_archivo} ({enviado / MB:.1f}MB)")
+        return {'archivo': nombre_archivo, 'bytes': enviado, 'segundos': max(time.time() - inicio, 0.001)}
+
+    except Exception as e:
+        logger.error(f"Error en streaming: {e}")
+        return None
+
+    finally:
+        for proceso in (origen, conversor):
+            if proceso.returncode is None:
+                matar_grupo(proceso)
+                await proceso.wait()
+        for tarea in tareas + [errores_origen, errores_conversor]:
+            tarea.cancel()
+
+# ==================== PREFETCH ESPECULATIVO ====================
+
+class Prefetch:
+    """Descarga especulativa de la fuente mientras el usuario elige formato"""
+    def __init__(self, usuario_id, url, plan, bytes_estimados):
+        self.usuario_id = usuario_id
+        self.url = url
+        self.plan = plan
+        self.bytes_estimados = bytes_estimados
+        self.reserva = None
+        self.tarea = None
+        self.expiracion = None
+        # threading.Event: lo consulta el hook desde el hilo del executor
+        self.cancelado = threading.Event()
+        self.inicio = time.time()
+        # Lo actualiza el hook: bytes ya en disco y cuándo llegó el último bloque
+        self.bytes_descargados = 0
+        self.ultimo_progreso = None
+        self.completado = False
+        self.fin = None
+
+    def aprovechable(self):
+        """Completo, o parcial con un .part que yt-dlp puede continuar"""
+        return self.completado or self.bytes_descargados > 0
+
+    def segundos_adelantados(self):
+        """Tiempo de descarga real que se ahorra el trabajo, no el tiempo desde el enlace"""
+        if self.completado:
+            return self.fin - self.inicio
+        if self.ultimo_progreso:
+            return self.ultimo_progreso - self.inicio
+        return 0.0
+
+class GestorPrefetch:
+    """Lanza, adopta y descarta prefetches con presupuesto por usuario y global"""
+    def __init__(self):
+        self.activos = {}
+        self.aciertos = 0
+        self.fallos = 0
+        self.descartados = 0
+        self.segundos_ahorrados = 0.0
+
+    def bytes_en_uso(self):
+        return sum(p.bytes_estimados for p in self.activos.values())
+
+    async def iniciar(self, usuario_id, url, info, formato_previsto):
+        """Empieza a descargar la fuente más probable si el presupuesto lo permite"""
+        if usuario_id in self.activos:
+            await self.descartar(self.activos[usuario_id], "nuevo enlace")
+
+        if not PREFETCH_HABILITADO or not info or info['es_playlist']:
+            return
+        if not circuitos_disponibles("yt-dlp", plataforma_de(url)):
+            return
+
+        plan = planificar_formato(info, formato_previsto)
+        bytes_estimados = estimar_tamano_trabajo(info, formato_previsto)
+
+        if bytes_estimados > PREFETCH_MAX_MB_USUARIO * MB:
+            return
+        if (len(self.activos) >= PREFETCH_MAX_GLOBAL
+                or self.bytes_en_uso() + bytes_estimados > PREFETCH_MAX_MB_GLOBAL * MB):
+            logger.info("Prefetch omitido: presupuesto global agotado")
+            return
+
+        prefetch = Prefetch(usuario_id, url, plan, bytes_estimados)
+        self.activos[usuario_id] = prefetch
+        prefetch.tarea = asyncio.create_task(self._descargar(prefetch, info))
+        prefetch.expiracion = asyncio.get_event_loop().call_later(
+            PREFETCH_TTL, lambda: asyncio.create_task(self.descartar(prefetch, "expirado"))
+        )
+
+    async def _descargar(self, prefetch, info):
+        try:
+            # Sin espera: un prefetch nunca debe retrasar trabajos reales
+            prefetch.reserva = await gestor_staging.reservar(
+                prefetch.bytes_estimados,
+                permitir_tmpfs=prefetch.plan['formato'] != "mp4",
+                timeout=0
+            )
+        except EspacioInsuficienteError:
+            logger.info("Prefetch omitido: sin espacio de staging")
+            await self._abandonar(prefetch)
+            return
+
+        cuota = await presupuesto_descarga.asignar(especulativa=True)
+        if cuota is None:
+            logger.info("Prefetch omitido: sin conexiones libres")
+            await self._abandonar(prefetch)
+            return
+        # aria2c no pasa por los progress hooks y no se podría cancelar
+        cuota.usa_aria2c = False
+
+        def hook(d):
+            if prefetch.cancelado.is_set():
+                raise DescargaCancelada("prefetch cancelado")
+            if d.get('downloaded_bytes'):
+                prefetch.bytes_descargados = d['downloaded_bytes']
+                prefetch.ultimo_progreso = time.time()
+
+        # Solo la fuente: la conversión la hace el trabajo real al adoptarla
+        ydl_opts = {
+            'format': prefetch.plan['selector'],
+            'outtmpl': f'{prefetch.reserva.ruta}/%(title)s.%(ext)s',
+            'quiet': True,
+            'no_warnings': True,
+            'progress_hooks': [hook],
+            **cuota.opciones_ytdlp(),
+        }
+
+        def download_sync():
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                cuota.vincular(ydl)
+                ydl.download([prefetch.url])
+
+        fallido = False
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, download_sync)
+            prefetch.fin = time.time()
+            prefetch.completado = True
+            logger.info(f"Prefetch completado en {prefetch.segundos_adelantados():.1f}s: {prefetch.url}")
+        except Exception as e:
+            if not prefetch.cancelado.is_set():
+                logger.warning(f"Prefetch fallido: {e}")
+                fallido = True
+        finally:
+            cuota.desvincular()
+            await presupuesto_descarga.liberar(cuota)
+        if fallido:
+            await self._abandonar(prefetch)
+
+    async def _abandonar(self, prefetch):
+        """Libera al momento el hueco y el staging de un prefetch que no llegó a servir"""
+        if prefetch.expiracion:
+            prefetch.expiracion.cancel()
+        if self.activos.get(prefetch.usuario_id) is prefetch:
+            self.activos.pop(prefetch.usuario_id)
+        if prefetch.reserva:
+            await prefetch.reserva.liberar()
+            prefetch.reserva = None
+
+    async def _detener(self, prefetch):
+        """Detiene la descarga en curso; yt-dlp deja el .part para continuarlo"""
+        if prefetch.expiracion:
+            prefetch.expiracion.cancel()
+        self.activos.pop(prefetch.usuario_id, None)
+        prefetch.cancelado.set()
+        if prefetch.tarea and not prefetch.tarea.done():
+            await asyncio.wait({prefetch.tarea}, timeout=10)
+
+    async def _liberar_reserva(self, prefetch):
+        """Libera el staging del prefetch, esperando al hilo si todavía escribe en él"""
+        if not prefetch.reserva:
+            return
+        if prefetch.tarea and not prefetch.tarea.done():
+            liberar_al_terminar(prefetch.reserva, prefetch.tarea)
+        else:
+            await prefetch.reserva.liberar()
+
+    async def descartar(self, prefetch, motivo):
+        """Cancela un prefetch no usado y libera su staging"""
+        if self.activos.get(prefetch.usuario_id) is not prefetch:
+            return
+        await self._detener(prefetch)
+        await self._liberar_reserva(prefetch)
+        self.descartados += 1
+        logger.info(f"Prefetch descartado ({motivo}): {prefetch.url}")
+
+    def pendiente(self, usuario_id, url):
+        prefetch = self.activos.get(usuario_id)
+        return prefetch is not None and prefetch.url == url
+
+    async def adoptar(self, usuario_id, url, plan):
+        """Entrega el staging del prefetch al trabajo si descargó la fuente que este necesita"""
+        prefetch = self.activos.get(usuario_id)
+        if prefetch is None:
+            return None, 0.0
+
+        if prefetch.url != url or prefetch.plan['selector'] != plan['selector']:
+            await self.descartar(prefetch, "formato distinto")
+            self.fallos += 1
+            return None, 0.0
+
+        await self._detener(prefetch)
+        # Un prefetch que falló sin bajar nada no cuenta como acierto
+        if (prefetch.reserva is None or not (prefetch.tarea and prefetch.tarea.done())
+                or not prefetch.aprovechable()):
+            await self._liberar_reserva(prefetch)
+            self.fallos += 1
+            return None, 0.0
+
+        ahorrado = prefetch.segundos_adelantados()
+        self.aciertos += 1
+        self.segundos_ahorrados += ahorrado
+        logger.info(
+            f"Prefetch adoptado (~{ahorrado:.1f}s ahorrados, aciertos {self.aciertos}/"
+            f"{self.aciertos + self.fallos})"
+        )
+        return prefetch.reserva, ahorrado
+
+    def resumen(self):
+        usados = self.aciertos + self.fallos
+        tasa = self.aciertos / usados * 100 if usados else 0
+        return (
+            f"⚡ Prefetch: {'activo' if PREFETCH_HABILITADO else 'desactivado'}\n"
+            f"• Aciertos: {self.aciertos}/{usados} ({tasa:.0f}%)\n"
+            f"• Descartados sin usar: {self.descartados}\n"
+            f"• Latencia ahorrada: {self.segundos_ahorrados:.1f}s\n"
+        )
+
+gestor_prefetch = GestorPrefetch()
 
 # ==================== COMANDO INFO CON TIEMPOS ====================
 
@@ -400,7 +1986,7 @@ async def info_comando(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    url = context.args[0]
+    url = normalizar_url(context.args[0])
 
     if not any(x in url for x in ["spotify.com", "youtu.be", "m.youtube.com", "youtube.com", 
         "bandcamp.com", "soundcloud.com", "vt.tiktok.com", "vm.tiktok.com", "tiktok.com", "instagram.com", "facebook.com", "twitter.com", "reddit.com", "twitch.tv", "vimeo.com", "dailymotion.com", "vk.com", "ok.ru", "coub.com", "mixcloud.com", "deezer.com", "apple.com/music", "tidal.com", "qobuz.com", "amazon.com/music", "pandora.com", "pinterest.com", "pin.it", "co.pinterest.com"]):
@@ -413,7 +1999,7 @@ async def info_comando(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         # Obtener información
-        info = obtener_info_youtube(url)
+        info = await obtener_info_youtube(url)
         tiempo_analisis = time.time() - inicio
 
         if info:
@@ -525,6 +2111,17 @@ async def comando_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except:
         diagnostico += "❌ Spotify: No accesible\n"
 
+    # Estado de los circuit breakers
+    diagnostico += "\n🔌 CIRCUITOS:\n"
+    if circuitos:
+        for circuito in circuitos.values():
+            diagnostico += f"{circuito.descripcion()}\n"
+    else:
+        diagnostico += "• Sin llamadas registradas\n"
+
+    # Estadísticas de prefetch especulativo
+    diagnostico += "\n" + gestor_prefetch.resumen()
+
     # Instrucciones de solución
     diagnostico += "\n🔧 SOLUCIONES:\n\n"
     diagnostico += "📦 Para instalar dependencias:\n"
@@ -549,7 +2146,7 @@ async def comando_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ==================== FUNCIONES ACTUALIZADAS CON PROGRESO ====================
 
 async def recibir_enlace(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    url = update.message.text.strip()
+    url = normalizar_url(update.message.text)
 
     # Verificar plataformas soportadas
     plataformas_soportadas = [
@@ -570,15 +2167,26 @@ async def recibir_enlace(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     context.user_data["url"] = url
+    context.user_data["info"] = None
 
     # Análisis previo para YouTube con tiempo
-    if any(x in url for x in ["youtu.be", "youtube.com", "m.youtube.com"]):
+    if plataforma_de(url) == 'youtube':
         inicio_analisis = time.time()
         mensaje_analisis = await update.message.reply_text("🔍 Pre-analizando video...")
 
-        info = obtener_info_youtube(url)
+        # Proceso aparte con plazo: un análisis colgado se mata y no bloquea al bot
+        info = await obtener_info_youtube(url)
         tiempo_analisis = time.time() - inicio_analisis
 
+        # Los enlaces se procesan en paralelo: si el usuario ya envió otro, este análisis
+        # no debe pisar su info (tamaño, formatos, título) ni lanzar un prefetch
+        if context.user_data.get("url") != url:
+            await mensaje_analisis.edit_text("⏭️ Análisis descartado: enviaste otro enlace")
+            return
+
+        # Se guarda para predecir el espacio temporal que necesitará la descarga
+        context.user_data["info"] = info
+
         if info:
             duracion = f"{info['duracion']//60}:{info['duracion']%60:02d}" if info['duracion'] > 0 else "N/A"
 
@@ -592,6 +2200,12 @@ async def recibir_enlace(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"⬇️ Selecciona el formato:"
             )
 
+    # Adelantar la descarga de la fuente mientras el usuario elige (opt-in)
+    await gestor_prefetch.iniciar(
+        update.effective_user.id, url, context.user_data["info"],
+        context.user_data.get("ultimo_formato", "mp3")
+    )
+
     # Crear teclado de opciones
     keyboard = [
         [
@@ -599,10 +2213,13 @@ async def recibir_enlace(update: Update, context: ContextTypes.DEFAULT_TYPE):
             InlineKeyboardButton("🎶 FLAC", callback_data="format:flac"),
             InlineKeyboardButton("💽 WAV", callback_data="format:wav"),
             InlineKeyboardButton("📱 MP4", callback_data="format:mp4")
+        ],
+        [
+            InlineKeyboardButton("🎧 Original (sin recodificar)", callback_data="format:original")
         ]
     ]
 
-    if not any(x in url for x in ["youtu.be", "youtube.com", "m.youtube.com"]):
+    if plataforma_de(url) != 'youtube':
         await update.message.reply_text(
             "🎯 Selecciona el formato de descarga:",
             reply_markup=InlineKeyboardMarkup(keyboard)
@@ -625,6 +2242,9 @@ async def descargar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("⚠️ Error: No se encontró enlace válido.")
         return
 
+    # Formato más probable para el próximo prefetch de este usuario
+    context.user_data["ultimo_formato"] = formato
+
     # Crear tracker de progreso
     mensaje_inicial = await query.message.reply_text(
         f"🚀 INICIANDO DESCARGA\n"
@@ -634,61 +2254,212 @@ async def descargar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     tracker = ProgressTracker(mensaje_inicial)
 
-    # Crear directorio temporal
-    with tempfile.TemporaryDirectory() as temp_dir:
+    # Registrar el trabajo para poder retomarlo si el proceso se reinicia
+    trabajo = journal.registrar(
+        url=url,
+        formato=formato,
+        info=context.user_data.get("info"),
+        chat_id=query.message.chat_id,
+        usuario_id=query.from_user.id,
+        mensaje_origen_id=query.message.message_id,
+        mensaje_progreso_id=mensaje_inicial.message_id,
+    )
+
+    await ejecutar_trabajo(context.bot, trabajo, query.message, tracker)
+
+async def ejecutar_trabajo(bot, trabajo, mensaje_origen, tracker):
+    """Ejecuta un trabajo del journal; si el bot se detiene a mitad, queda pendiente"""
+    control = ControlTrabajo(trabajo, asyncio.current_task())
+    trabajos_activos[trabajo['id']] = control
+    tracker.reply_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🛑 Cancelar", callback_data=f"cancelar:{trabajo['id']}")]
+    ])
+
+    interrumpido = False
+    try:
+        await procesar_trabajo(bot, trabajo, mensaje_origen, tracker, control)
+    except asyncio.CancelledError:
+        if not control.cancelado.is_set():
+            # Apagado del bot: se conserva la entrada y el staging para reanudar
+            interrumpido = True
+            raise
+        # Cancelado por el usuario o por un plazo vencido: el staging ya se liberó
+        await tracker.finish_task(success=False)
+        await mensaje_origen.reply_text(
+            f"🛑 Descarga cancelada: {control.motivo}\n"
+            f"🧹 Procesos y espacio temporal liberados"
+        )
+    finally:
+        control.finalizar()
+        trabajos_activos.pop(trabajo['id'], None)
+        if not interrumpido:
+            journal.eliminar(trabajo['id'])
+
+async def procesar_trabajo(bot, trabajo, mensaje_origen, tracker, control):
+    """Descarga y envía los archivos de un trabajo, saltando las etapas ya completadas"""
+    url = normalizar_url(trabajo['url'])
+    formato = trabajo['formato']
+    info = trabajo['info']
+    plan = planificar_formato(info, formato)
+    # Líneas adicionales para el resumen final
+    lineas_extra = []
+
+    if plan['nota']:
+        lineas_extra.append(plan['nota'])
+
+    async def avisar_espera_conexiones():
+        await tracker.update_message(
+            "⏳ Esperando una conexión de descarga libre...\n"
+            "📶 Hay muchas descargas en curso"
+        )
+
+    # Audio individual que hay que recodificar: intentar el pipeline sin disco antes de reservar staging
+    # (si hay un prefetch de este enlace es más rápido adoptarlo, y un trabajo reanudado con
+    # staging ya tiene .part o el archivo convertido)
+    if (plan['modo'] == 'transcodificacion' and puede_transmitir(formato, info)
+            and not trabajo.get('staging')
+            and not gestor_prefetch.pendiente(trabajo.get('usuario_id'), url)
+            and circuitos_disponibles("yt-dlp-cli", plataforma_de(url))):
+        # El plazo cubre también la espera de conexiones
+        control.plazo(PLAZO_DESCARGA, "streaming")
+        cuota = await presupuesto_descarga.asignar(al_esperar=avisar_espera_conexiones)
+        try:
+            resultado = await transmitir_audio(
+                bot, trabajo['chat_id'], url, formato, info, tracker, cuota=cuota, control=control
+            )
+        finally:
+            await presupuesto_descarga.liberar(cuota)
+        if resultado:
+            # El streaming siempre transcodifica
+            estadisticas_codificacion.registrar(plan, (info or {}).get('duracion_total'))
+            await tracker.finish_task(success=True)
+            await mensaje_origen.reply_text(
+                f"📊 RESUMEN DETALLADO\n\n"
+                f"📁 Archivos procesados: 1\n"
+                f"✅ Enviados exitosamente: 1\n"
+                f"🎯 Formato: {formato.upper()}\n"
+                f"📡 Modo: streaming sin disco\n"
+                f"🚀 Velocidad media: {resultado['bytes'] / MB / resultado['segundos']:.2f}MB/s\n\n"
+                f"📋 Detalle de archivos:\n"
+                f"• ✅ {resultado['archivo']}: {resultado['bytes'] / MB:.1f}MB\n"
+                f"\n🔄 Envía otro enlace para continuar"
+            )
+            return
+        await tracker.start_task("Streaming falló, descargando a disco")
+
+    # Reservar directorio temporal según el tamaño previsto del trabajo
+    bytes_estimados = estimar_tamano_trabajo(info, formato)
+    permitir_tmpfs = formato != "mp4" and not (info and info['es_playlist'])
+
+    async def avisar_espera():
+        await tracker.update_message(
+            f"⏳ Esperando espacio de almacenamiento...\n"
+            f"📦 Necesario: ~{bytes_estimados / MB:.0f}MB"
+        )
+
+    # Desde aquí cualquier espera (staging, conexiones) cuenta para el plazo de descarga
+    control.plazo(PLAZO_DESCARGA, "descarga")
+
+    reserva = None
+    if not trabajo.get('staging'):
+        reserva, ahorrado = await gestor_prefetch.adoptar(trabajo.get('usuario_id'), url, plan)
+        if reserva:
+            # El staging del prefetch ya tiene la fuente (completa o en .part)
+            await gestor_staging.ajustar(reserva, max(bytes_estimados, reserva.bytes_reservados))
+            lineas_extra.append(f"⚡ Prefetch aprovechado (≈{ahorrado:.1f}s adelantados)")
+
+    try:
+        if reserva is None and trabajo.get('staging') and os.path.isdir(trabajo['staging']):
+            # Trabajo reanudado: su staging (con los .part) sigue en disco
+            reserva = await gestor_staging.readoptar(trabajo['staging'], trabajo['bytes_reservados'])
+        elif reserva is None:
+            if trabajo['etapa'] != 'descargando':
+                # Los archivos se perdieron (p. ej. tmpfs tras reiniciar la máquina)
+                journal.actualizar(trabajo['id'], etapa='descargando', enviados=[])
+            reserva = await gestor_staging.reservar(bytes_estimados, permitir_tmpfs, al_esperar=avisar_espera)
+    except EspacioInsuficienteError as e:
+        await tracker.finish_task(success=False)
+        await mensaje_origen.reply_text(
+            f"⏳ Servidor ocupado: {e}\n"
+            f"🔄 Inténtalo de nuevo en unos minutos."
+        )
+        return
+
+    reserva.persistente = True
+    control.reserva = reserva
+    journal.actualizar(trabajo['id'], staging=reserva.ruta, bytes_reservados=reserva.bytes_reservados)
+
+    cuota = None
+    async with reserva as temp_dir:
         try:
             exito = False
-            es_youtube = any(x in url for x in ["youtu.be", "youtube.com", "m.youtube.com"])
-            es_spotify = "spotify.com" in url
+            es_youtube = plataforma_de(url) == 'youtube'
+            es_spotify = plataforma_de(url) == 'spotify'
 
             # Determinar método de descarga
-            if es_spotify:
-                # Verificar spotdl antes de intentar
-                if not await verificar_spotdl():
-                    await tracker.start_task("Spotify no disponible, intentando con yt-dlp")
-                    await tracker.update_progress("Buscando alternativa en YouTube...")
-
-                    # Intentar con yt-dlp como respaldo
-                    exito = await descargar_youtube_con_progreso(url, formato, temp_dir, tracker)
-
-                    if not exito:
-                        await tracker.finish_task(success=False)
-                        await query.message.reply_text(
-                            "❌ Spotify no disponible\n\n"
-                            "🔧 Soluciones:\n"
-                            "1. Instala spotdl: pip install spotdl\n"
-                            "2. Verifica que FFmpeg esté instalado\n"
-                            "3. Configura spotdl: spotdl --generate-config\n"
-                            "4. Usa /config para diagnóstico completo\n\n"
-                            "💡 Alternativas:\n"
-                            "• Busca la canción en YouTube\n"
-                            "• Copia el nombre y búscalo manualmente"
-                        )
-                        return
-                else:
-                    exito = await descargar_spotify_con_progreso(url, temp_dir, tracker)
+            if trabajo['etapa'] == 'enviando':
+                # La descarga terminó antes del reinicio: pasar directo al envío
+                exito = True
+            else:
+                # Conexiones y ancho de banda del trabajo dentro del presupuesto global; se piden
+                # dentro del contexto para que una cancelación durante la espera libere el staging
+                cuota = await presupuesto_descarga.asignar(al_esperar=avisar_espera_conexiones)
+                rutas = rutas_descarga(url, formato, temp_dir, tracker, plan, cuota, control)
+                ruta, intentadas, bloqueos = await descargar_con_rutas(rutas, tracker, control)
+                exito = ruta is not None
+
+                if not exito and not intentadas and bloqueos:
+                    # Todos los circuitos abiertos: fallar rápido en vez de agotar timeouts
+                    espera = max(c.segundos_para_sonda() for c in bloqueos)
+                    await tracker.finish_task(success=False)
+                    await mensaje_origen.reply_text(
+                        f"⚡ {plataforma_de(url).capitalize()} no está disponible temporalmente\n"
+                        f"🔌 Demasiados fallos recientes: {', '.join(sorted({c.nombre for c in bloqueos}))}\n"
+                        f"🔄 Reintenta en {f'~{espera:.0f}s' if espera >= 1 else 'unos segundos'}"
+                    )
+                    return
 
-                    # Si falla Spotify, intentar con YouTube
-                    if not exito:
-                        await tracker.start_task("Spotify falló, intentando alternativa")
-                        await tracker.update_progress("Probando método alternativo...")
+                if not exito and es_spotify:
+                    await tracker.finish_task(success=False)
+                    await mensaje_origen.reply_text(
+                        "❌ Spotify no disponible\n\n"
+                        "🔧 Soluciones:\n"
+                        "1. Instala spotdl: pip install spotdl\n"
+                        "2. Verifica que FFmpeg esté instalado\n"
+                        "3. Configura spotdl: spotdl --generate-config\n"
+                        "4. Usa /config para diagnóstico completo\n\n"
+                        "💡 Alternativas:\n"
+                        "• Busca la canción en YouTube\n"
+                        "• Copia el nombre y búscalo manualmente"
+                    )
+                    return
 
-                        # Extraer nombre de la canción para buscar en YouTube
-                        try:
-                            import re
-                            # Extraer información básica del enlace de Spotify
-                            if "/track/" in url:
-                                track_id = url.split("/track/")[1].split("?")[0]
-                                search_query = f"ytsearch1:{track_id}"  # Búsqueda básica
-                                exito = await descargar_youtube_con_progreso(search_query, formato, temp_dir, tracker)
-                        except:
-                            pass
-            elif es_youtube:
-                exito = await descargar_youtube_con_progreso(url, formato, temp_dir, tracker)
-            else:  # SoundCloud, Bandcamp
-                exito = await descargar_otros_con_progreso(url, formato, temp_dir, tracker)
+                if exito and len(intentadas) > 1:
+                    lineas_extra.append(f"🔀 Ruta alternativa: {ruta['descripcion']}")
+
+                if exito and formato != "mp4":
+                    # Solo el yt-dlp en proceso sigue el plan; el CLI y spotdl convierten siempre
+                    if ruta['motor'] == 'yt-dlp':
+                        plan_usado = plan
+                    elif ruta['motor'] == 'spotdl':
+                        plan_usado = planificar_formato(None, "mp3")
+                    else:
+                        plan_usado = planificar_formato(None, formato)
+                    ahorrado = estadisticas_codificacion.registrar(plan_usado, (info or {}).get('duracion_total'))
+                    linea = f"⚙️ Procesamiento: {DESCRIPCION_MODO[plan_usado['modo']]}"
+                    if ahorrado:
+                        linea += f" (≈{ahorrado:.1f}s de CPU ahorrados)"
+                    lineas_extra.append(linea)
+
+            # La red ya no se usa: devolver la cuota antes de enviar
+            if cuota:
+                await presupuesto_descarga.liberar(cuota)
+                if cuota.resumen():
+                    lineas_extra.append(cuota.resumen())
 
             if exito:
+                journal.actualizar(trabajo['id'], etapa='enviando')
+                control.plazo(PLAZO_ENVIO, "envío")
                 await tracker.start_task("Enviando archivos")
 
                 archivos = [f for f in os.listdir(temp_dir) if os.path.isfile(os.path.join(temp_dir, f))]
@@ -697,14 +2468,19 @@ async def descargar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 if not archivos:
                     await tracker.finish_task(success=False)
-                    await query.message.reply_text("❌ No se encontraron archivos descargados.")
+                    await mensaje_origen.reply_text("❌ No se encontraron archivos descargados.")
                     return
 
                 for archivo in archivos:
                     ruta = os.path.join(temp_dir, archivo)
                     tamaño_mb = os.path.getsize(ruta) / (1024 * 1024)
 
-                    if tamaño_mb > 50:
+                    if archivo in trabajo['enviados']:
+                        archivos_enviados += 1
+                        archivos_info.append(f"✅ {archivo}: {tamaño_mb:.1f}MB (enviado antes del reinicio)")
+                        continue
+
+                    if tamaño_mb > LIMITE_ENVIO_MB:
                         archivos_info.append(f"⚠️ {archivo}: {tamaño_mb:.1f}MB (muy grande)")
                         continue
 
@@ -713,13 +2489,13 @@ async def descargar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                         if formato == "mp4" and archivo.endswith(('.mp4', '.mkv', '.webm')):
                             with open(ruta, "rb") as video_file:
-                                await query.message.reply_video(
+                                await mensaje_origen.reply_video(
                                     video=video_file,
                                     caption=f"📱 {archivo}\n🎯 {formato.upper()} • {tamaño_mb:.1f}MB"
                                 )
                         else:
                             with open(ruta, "rb") as audio_file:
-                                await query.message.reply_audio(
+                                await mensaje_origen.reply_audio(
                                     audio=audio_file,
                                     title=archivo.rsplit('.', 1)[0],
                                     caption=f"🎵 {archivo}\n🎯 {archivo.split('.')[-1].upper()} • {tamaño_mb:.1f}MB"
@@ -727,6 +2503,7 @@ async def descargar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                         tiempo_envio = time.time() - inicio_envio
                         archivos_enviados += 1
+                        journal.actualizar(trabajo['id'], enviados=trabajo['enviados'] + [archivo])
                         archivos_info.append(f"✅ {archivo}: {tamaño_mb:.1f}MB ({tiempo_envio:.1f}s)")
 
                     except Exception as e:
@@ -740,7 +2517,10 @@ async def descargar(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 resumen = f"📊 RESUMEN DETALLADO\n\n"
                 resumen += f"📁 Archivos procesados: {len(archivos)}\n"
                 resumen += f"✅ Enviados exitosamente: {archivos_enviados}\n"
-                resumen += f"🎯 Formato: {formato.upper()}\n\n"
+                resumen += f"🎯 Formato: {formato.upper()}\n"
+                for linea in lineas_extra:
+                    resumen += f"{linea}\n"
+                resumen += "\n"
 
                 if archivos_info:
                     resumen += "📋 Detalle de archivos:\n"
@@ -749,16 +2529,116 @@ async def descargar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 resumen += f"\n🔄 Envía otro enlace para continuar"
 
-                await query.message.reply_text(resumen)
+                await mensaje_origen.reply_text(resumen)
 
             else:
                 await tracker.finish_task(success=False)
-                await query.message.reply_text("❌ Error durante la descarga. Revisa la consola para más detalles.")
+                await mensaje_origen.reply_text("❌ Error durante la descarga. Revisa la consola para más detalles.")
 
         except Exception as e:
             await tracker.finish_task(success=False)
             logger.error(f"Error general en descarga: {e}")
-            await query.message.reply_text(f"❌ Error inesperado:\n{str(e)[:200]}")
+            await mensaje_origen.reply_text(f"❌ Error inesperado:\n{str(e)[:200]}")
+
+        finally:
+            if cuota:
+                await presupuesto_descarga.liberar(cuota)
+
+async def cancelar_boton(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Botón de cancelar del mensaje de progreso"""
+    query = update.callback_query
+    trabajo_id = query.data.split(":")[1]
+    control = trabajos_activos.get(trabajo_id)
+
+    if control is None:
+        await query.answer("ℹ️ Este trabajo ya terminó")
+        return
+
+    if control.usuario_id not in (None, query.from_user.id):
+        await query.answer("⛔ Solo quien inició la descarga puede cancelarla", show_alert=True)
+        return
+
+    await query.answer("🛑 Cancelando...")
+    control.cancelar("cancelado por el usuario")
+
+async def comando_cancelar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancela todas las descargas en curso del usuario"""
+    usuario_id = update.effective_user.id
+    controles = [c for c in trabajos_activos.values() if c.usuario_id == usuario_id]
+
+    prefetch = gestor_prefetch.activos.get(usuario_id)
+    if prefetch:
+        await gestor_prefetch.descartar(prefetch, "cancelado por el usuario")
+
+    if not controles:
+        await update.message.reply_text("ℹ️ No tienes descargas en curso.")
+        return
+
+    for control in controles:
+        control.cancelar("cancelado con /cancel")
+
+    await update.message.reply_text(f"🛑 Cancelando {len(controles)} descarga(s)...")
+
+# ==================== REANUDACIÓN DE TRABAJOS ====================
+
+# Referencias a las tareas reanudadas para que no las recoja el GC
+tareas_reanudadas = set()
+
+def mensaje_existente(bot, chat_id, message_id):
+    """Reconstruye un mensaje ya enviado para poder editarlo o responderle"""
+    mensaje = Message(
+        message_id=message_id,
+        date=datetime.now(),
+        chat=Chat(id=chat_id, type=Chat.PRIVATE)
+    )
+    mensaje.set_bot(bot)
+    return mensaje
+
+async def reanudar_trabajos(app):
+    """Retoma los trabajos que quedaron sin terminar en el journal"""
+    pendientes = journal.pendientes()
+    if not pendientes:
+        return
+
+    logger.info(f"Reanudando {len(pendientes)} trabajos del journal")
+
+    for trabajo in pendientes:
+        mensaje_origen = mensaje_existente(app.bot, trabajo['chat_id'], trabajo['mensaje_origen_id'])
+
+        # Un trabajo que tumba el proceso (p. ej. por memoria) no debe reanudarse para siempre
+        intentos = trabajo.get('intentos', 0) + 1
+        horas = (datetime.now() - datetime.fromisoformat(trabajo['creado'])).total_seconds() / 3600
+        if intentos > REANUDAR_MAX_INTENTOS or horas > REANUDAR_MAX_HORAS:
+            logger.warning(
+                f"Trabajo {trabajo['id']} abandonado tras {intentos - 1} reanudaciones ({horas:.1f}h)"
+            )
+            journal.eliminar(trabajo['id'])
+            if trabajo.get('staging'):
+                shutil.rmtree(trabajo['staging'], ignore_errors=True)
+            try:
+                await mensaje_origen.reply_text(
+                    "❌ La descarga no pudo completarse tras varios reinicios del bot\n"
+                    "💡 Vuelve a enviar el enlace o prueba otro formato"
+                )
+            except Exception as e:
+                logger.error(f"No se pudo avisar del trabajo abandonado: {e}")
+            continue
+
+        # Se guarda antes de empezar: si este intento tumba el proceso, ya cuenta
+        journal.actualizar(trabajo['id'], intentos=intentos)
+
+        mensaje_progreso = mensaje_existente(app.bot, trabajo['chat_id'], trabajo['mensaje_progreso_id'])
+
+        tracker = ProgressTracker(mensaje_progreso)
+        await tracker.update_message(
+            f"♻️ REANUDANDO DESCARGA\n"
+            f"🎯 Formato: {trabajo['formato'].upper()}\n"
+            f"📍 Etapa: {trabajo['etapa']}"
+        )
+
+        tarea = asyncio.create_task(ejecutar_trabajo(app.bot, trabajo, mensaje_origen, tracker))
+        tareas_reanudadas.add(tarea)
+        tarea.add_done_callback(tareas_reanudadas.discard)
 
 # ==================== CONFIGURACIÓN DEL BOT ====================
 
@@ -802,16 +2682,25 @@ def main():
         os.makedirs(DOWNLOAD_DIR)
         print(f"📁 Directorio creado: {DOWNLOAD_DIR}")
 
+    # Recuperar espacio de trabajos interrumpidos en ejecuciones anteriores
+    eliminados, liberados = gestor_staging.limpiar_huerfanos(conservar=journal.rutas_staging())
+    if eliminados:
+        print(f"🧹 Staging huérfano eliminado: {eliminados} directorios ({liberados / MB:.1f}MB)")
+
     # Configurar el bot
-    app = Application.builder().token(TOKEN).build()
+    app = Application.builder().token(TOKEN).post_init(reanudar_trabajos).build()
 
     # Añadir manejadores
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("ayuda", ayuda))
     app.add_handler(CommandHandler("info", info_comando))
     app.add_handler(CommandHandler("config", comando_config))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, recibir_enlace))
-    app.add_handler(CallbackQueryHandler(descargar, pattern="^format:"))
+    # Sin bloqueo: /cancel y el botón de cancelar deben atenderse durante una descarga
+    app.add_handler(CommandHandler("cancel", comando_cancelar, block=False))
+    # Sin bloquear: un análisis lento no debe retrasar /cancel ni los botones de otros usuarios
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, recibir_enlace, block=False))
+    app.add_handler(CallbackQueryHandler(descargar, pattern="^format:", block=False))
+    app.add_handler(CallbackQueryHandler(cancelar_boton, pattern="^cancelar:", block=False))
 
     print("🤖 Bot iniciado correctamente")
     print("📊 Características:")